@@ -0,0 +1,375 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from hashlib import sha256
+from typing import Awaitable, Callable
+
+import aiohttp
+import websockets
+
+import metrics
+from emoji_catalog import EmojiCatalog
+from http_client import ApiError, HttpClient
+from notification import Notification
+from pipeline import Event, Pipeline
+from reconnect import Backoff, RecentIds
+from streaming import Channel, StreamConnection
+
+log_main = logging.getLogger("main")
+
+
+class AccountError(Exception):
+    """起動時の確認で続行できない問題が見つかった場合の例外"""
+
+    def __init__(self, message: str, log_message: str) -> None:
+        """
+        Args:
+            message (str): ユーザーに表示するメッセージ
+            log_message (str): ログに出力するメッセージ
+        """
+        super().__init__(log_message)
+        self.message = message
+        self.log_message = log_message
+
+
+class Account:
+    """
+    1つのアカウント(インスタンス+トークン)のストリーミング接続とAPIクライアント
+
+    画像キャッシュ/HTTPクライアント/パイプラインは全アカウントで共有する
+    """
+
+    def __init__(
+        self,
+        host: str,
+        token: str,
+        http: HttpClient,
+        settings: dict,
+        label: str | None = None,
+        scheme: str = "https",
+        data_dir: str = ".data",
+        started_at: float | None = None,
+        channels: list[dict] | None = None,
+    ) -> None:
+        """
+        Args:
+            host (str): インスタンスのドメイン
+            token (str): APIトークン
+            http (HttpClient): 共有するHTTPクライアント
+            settings (dict): config.jsonの共通設定
+            label (str | None, optional): 通知やメニューに表示する名前(省略時はドメイン)
+            scheme (str, optional): httpsまたはhttp(ローカルのテスト用サーバーに接続する場合)
+            data_dir (str, optional): プロフィールと絵文字の一覧のキャッシュを保存するフォルダ
+            started_at (float | None, optional): 起動した時刻(time.perf_counter), 起動時間のログ用
+            channels (list[dict] | None, optional): mainの他に購読するチャンネル
+                                                    (例: {"channel": "antenna", "params": {"antennaId": "..."}, "name": "仕事"})
+        """
+        self.host = host
+        self.token = token
+        self.http = http
+        self.settings = settings
+        self.label = label or host
+        self.base_url = f"{scheme}://{host}"
+        self.ws_url = f"{'wss' if scheme == 'https' else 'ws'}://{host}/streaming?i={token}"
+        self.authorized = False  # APIトークンが確認できたかどうか
+        self.me: dict | None = None
+        self.last_id: str | None = None  # 最後に受け取った通知のID
+        self.recent_ids = RecentIds(settings.get("dedup_size", 1000))
+        self.recent_note_ids = RecentIds(settings.get("dedup_size", 1000))  # アンテナ/リストなどのノート用
+        self.started_at = started_at
+        # 1本の接続にmainと追加のチャンネルを載せる(mainのチャンネルIDは"1")
+        self.stream = StreamConnection(
+            self.ws_url,
+            self.label,
+            ping_interval=settings.get("ws_ping_interval", 15),
+            ping_timeout=settings.get("ws_ping_timeout", 5),
+        )
+        self.stream.subscribe("main", self._submit)
+        for channel_config in channels or []:
+            self.stream.subscribe(
+                channel_config["channel"],
+                self._submit,
+                params=channel_config.get("params"),
+                label=channel_config.get("name"),
+            )
+        self._pipeline: Pipeline | None = None
+        self._reconnect_requested = False  # reconnect()で切断した場合は失敗として数えない
+        self._wake = asyncio.Event()  # 再接続の待ち時間を打ち切る
+        # トークンごとにプロフィールをキャッシュする(ファイル名にトークンそのものは使わない)
+        token_hash = sha256(f"{host}:{token}".encode()).hexdigest()[:16]
+        self.profile_cache_path = os.path.join(data_dir, f"me_{token_hash}.json")
+        self._load_profile_cache()
+        # カスタム絵文字の一覧はインスタンスごと
+        host_hash = sha256(host.encode()).hexdigest()[:16]
+        self.emojis = EmojiCatalog(http, self.base_url, os.path.join(data_dir, f"emojis_{host_hash}.json"))
+
+    def __repr__(self) -> str:
+        return f"<Account {self.label}>"
+
+    async def bootstrap(self) -> None:
+        """
+        サーバーの生存確認と、APIトークンの確認を兼ねた自分のプロフィールの取得を並行して行う
+        ストリーミング接続はこれを待たずに開始してよい
+
+        Raises:
+            AccountError: 続行できない問題が見つかった場合
+        """
+        started = time.perf_counter()
+        await asyncio.gather(self._health_check(), self._load_profile())
+        log_main.info(
+            f"[{self.label}] startup checks finished in {(time.perf_counter() - started) * 1000:.0f}ms"
+        )
+
+    async def _health_check(self) -> None:
+        """サーバーの生存確認"""
+        log_main.info(f"[{self.label}] Connection check")
+        try:
+            resp_code = await self.http.status(self.base_url)
+            log_main.info(f"[{self.label}] Connection check success")
+        except (aiohttp.ClientError, TimeoutError):
+            raise AccountError(
+                "サーバーへの接続ができませんでした\n入力したドメインが正しいかどうかを確認してください",
+                "Cannot connect to server! Please check domain.",
+            )
+        match resp_code:
+            case 404:
+                raise AccountError(
+                    "API接続ができませんでした\n - 利用しているインスタンスが正常に稼働しているか\n - 入力したドメインが正しいかどうか\nを確認してください",
+                    "Unable to connect to API! Please check domain and token.",
+                )
+            case 410 | 500 | 502 | 503:
+                raise AccountError(
+                    f"サーバーが正常に応答しませんでした\n利用しているインスタンスが正常に稼働しているかを確認してください\nStatusCode: {resp_code}",
+                    f"Server is not responding normally! Please check instance is running. StatusCode: {resp_code}",
+                )
+            case 429:
+                raise AccountError(
+                    "レートリミットに達しました\nしばらくしてから再実行してください",
+                    "Rate limit reached! Please try again later.",
+                )
+
+    async def _load_profile(self) -> None:
+        """自分のプロフィールの取得(APIトークンの確認を兼ねる)"""
+        log_main.info(f"[{self.label}] Misskey API connection check")
+        try:
+            me = await self.http.api(self.base_url, "i", self.token)
+            log_main.info(f"[{self.label}] Misskey API connection check success")
+        except (aiohttp.ClientConnectionError, TimeoutError):
+            raise AccountError(
+                "ドメインが違います\nconfig.jsonを削除/編集してもう一度入力しなおしてください",
+                "Domain is wrong! Please check domain.",
+            )
+        except ApiError as e:
+            if e.status in (401, 403):
+                raise AccountError(
+                    "APIキーが違います\nconfig.jsonを削除/編集して入力しなおしてください",
+                    "API key is wrong! Please check API key.",
+                )
+            raise AccountError(
+                "サーバー接続時にエラーが発生しました\nドメイン/APIキーが正しいかどうか確認してください",
+                f"Cannot connect to server! Please check domain/API key. StatusCode: {e.status}",
+            )
+        except aiohttp.ClientError:
+            raise AccountError(
+                "サーバー接続時にエラーが発生しました\nドメイン/APIキーが正しいかどうか確認してください",
+                "Cannot connect to server! Please check domain/API key.",
+            )
+        self.authorized = True
+        self.me = me
+        await asyncio.to_thread(self._save_profile_cache, me)
+
+    def _load_profile_cache(self) -> None:
+        """前回取得したプロフィールを読み込む(起動直後から使えるように)"""
+        try:
+            with open(file=self.profile_cache_path, mode="r", encoding="UTF-8") as f:
+                self.me = json.load(f)
+            log_main.info(f"[{self.label}] cached profile loaded")
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+
+    def _save_profile_cache(self, me: dict) -> None:
+        tmp_path = f"{self.profile_cache_path}.tmp"
+        with open(file=tmp_path, mode="w", encoding="UTF-8") as f:
+            json.dump(me, f)
+        os.replace(tmp_path, self.profile_cache_path)
+
+    def accept(self, notification: Notification) -> bool:
+        """
+        通知を既に受け取っていないか確認し、最後に受け取った通知のIDを更新する
+
+        Args:
+            notification (Notification): 通知
+
+        Returns:
+            bool: 初めて受け取った通知の場合はTrue
+        """
+        notification_id = notification.id
+        if notification_id is None:
+            return True
+        if not self.recent_ids.add(notification_id):
+            log_main.debug(f"[{self.label}] duplicate notification: {notification_id}")
+            return False
+        if self.last_id is None or notification_id > self.last_id:
+            self.last_id = notification_id
+        return True
+
+    def accept_note(self, notification: Notification) -> bool:
+        """
+        アンテナ/リストなどのチャンネルのノートを既に受け取っていないか確認する
+        (複数のチャンネルに同じノートが流れてくる場合があるため, 取りこぼし取得の位置には使わない)
+
+        Returns:
+            bool: 初めて受け取ったノートの場合はTrue
+        """
+        if notification.id is None:
+            return True
+        return self.recent_note_ids.add(notification.id)
+
+    async def catch_up(self, pipeline: Pipeline) -> None:
+        """
+        切断中に届いていた通知をAPIから取得してパイプラインに入れる
+        最後に受け取った通知のID以降をページングしながら取得する
+        """
+        since_id = self.last_id
+        if since_id is None or not self.authorized:
+            return
+        limit = 100
+        cursor_since, cursor_until = since_id, None
+        missed: list[dict] = []
+        for _ in range(self.settings.get("catch_up_max_pages", 5)):
+            try:
+                page = await self.http.api(
+                    self.base_url,
+                    "i/notifications",
+                    self.token,
+                    limit=limit,
+                    sinceId=cursor_since,
+                    untilId=cursor_until,
+                    markAsRead=False,
+                )
+            except (aiohttp.ClientError, ApiError, TimeoutError):
+                log_main.warning(f"[{self.label}] catch-up request failed")
+                break
+            missed.extend(page)
+            if len(page) < limit:
+                break
+            # サーバーによって新しい順/古い順が違うので並びを見て次のページの取り方を決める
+            if page[0]["id"] < page[-1]["id"]:
+                cursor_since = page[-1]["id"]
+            else:
+                cursor_until = page[-1]["id"]
+        log_main.info(f"[{self.label}] catch-up: {len(missed)} notifications since {since_id}")
+        for recv_body in sorted(missed, key=lambda body: body["id"]):
+            notification = Notification.from_dict(recv_body)
+            if self.accept(notification):
+                await pipeline.inject(Event(notification, account=self))
+
+    async def mark_all_as_read(self) -> bool:
+        """
+        通知をすべて既読にする
+
+        Returns:
+            bool: 成功した場合はTrue
+        """
+        if not self.authorized:
+            return False
+        try:
+            await self.http.api(self.base_url, "notifications/mark-all-as-read", self.token)
+            return True
+        except (aiohttp.ClientError, ApiError, TimeoutError):
+            log_main.warning(f"[{self.label}] mark all as read failed")
+            return False
+
+    async def reconnect(self) -> None:
+        """
+        今すぐ再接続する
+        接続中の場合は切断してすぐに繋ぎ直し、再接続を待っている場合は待ち時間を打ち切る
+        """
+        log_main.info(f"[{self.label}] reconnect requested")
+        if self.stream.ws is not None:
+            self._reconnect_requested = True
+            await self.stream.close()
+        else:
+            self._wake.set()
+
+    async def _wait_reconnect(self, delay: float) -> None:
+        """再接続までの待ち時間(reconnect()が呼ばれたら打ち切る)"""
+        self._wake.clear()
+        try:
+            await asyncio.wait_for(self._wake.wait(), delay)
+        except TimeoutError:
+            pass
+
+    async def _submit(self, channel: Channel, frame: str | bytes) -> None:
+        """受信したフレームを解析せずにパイプラインに入れる(どのチャンネルのフレームかを添える)"""
+        await self._pipeline.submit((self, channel, frame))  # type: ignore[union-attr]
+
+    async def websocket_connect(
+        self, pipeline: Pipeline, notify: Callable[[str], Awaitable[None]]
+    ) -> None:
+        """
+        websocket接続するためのやつ
+        受信したフレームはパイプラインに入れるだけで、解析や通知は別のワーカーで行う
+        切断された場合(ハートビートの応答が無かった場合を含む)は指数的に待ち時間を伸ばしながら再接続し、
+        切断中の通知を取得し直す
+
+        Args:
+            pipeline (Pipeline): 受信したフレームを入れるパイプライン
+            notify (Callable): 接続状態をユーザーに知らせるためのコルーチン関数(内容だけを受け取る)
+        """
+        backoff = Backoff(
+            base=self.settings.get("ws_reconnect_base", 1),
+            cap=self.settings.get("ws_reconnect_max_delay", 60),
+            healthy_after=self.settings.get("ws_healthy_after", 30),
+        )
+        self._pipeline = pipeline
+        while True:
+            try:
+                # websocket接続(接続時に全てのチャンネルの購読を送信する)
+                async with self.stream.connect():
+                    print(f"[{self.label}] ws connect")
+                    log_main.info(
+                        f"[{self.label}] Websocket connected ({len(self.stream.channels)} channels)"
+                    )
+                    print(f"[{self.label}] ready")
+                    if self.started_at is not None:
+                        log_main.info(
+                            f"[{self.label}] ready in {(time.perf_counter() - self.started_at) * 1000:.0f}ms"
+                        )
+                        self.started_at = None
+                    else:
+                        log_main.info(f"[{self.label}] ready")
+                    backoff.connected()
+                    catch_up_task = asyncio.create_task(self.catch_up(pipeline))
+                    try:
+                        await self.stream.serve()
+                    finally:
+                        catch_up_task.cancel()
+            except (
+                websockets.exceptions.ConnectionClosed,
+                websockets.exceptions.InvalidHandshake,
+                OSError,
+                TimeoutError,  # StaleConnectionを含む
+            ) as e:
+                if self._reconnect_requested:
+                    self._reconnect_requested = False
+                    log_main.info(f"[{self.label}] reconnecting now")
+                    continue
+                backoff.disconnected()
+                metrics.RECONNECTS.inc(account=self.label)
+                if backoff.attempts >= self.settings["ws_reconnect_limit"]:
+                    print(f"[{self.label}] websocket disconnected. reconnect limit reached.")
+                    log_main.critical(f"[{self.label}] websocket disconnected. reconnect limit reached.")
+                    await notify("再接続の回数が既定の回数を超えたため中断して終了します")
+                    return
+                first_attempt = backoff.attempts == 0
+                delay = backoff.next_delay()
+                log_main.warning(
+                    f"[{self.label}] Websocket disconnected ({e!r}). reconnecting in {delay:.1f}s... "
+                    f"trials count: {backoff.attempts}"
+                )
+                if first_attempt:
+                    await notify(f"サーバーから切断されました\n{delay:.0f}秒後に再接続します...")
+                await self._wait_reconnect(delay)
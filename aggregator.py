@@ -0,0 +1,175 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Hashable
+
+from notification import Notification
+from pipeline import Event
+
+log_aggregator = logging.getLogger("aggregator")
+
+
+def _note_key(body: Notification) -> str | None:
+    return body.note.id if body.note is not None else None
+
+
+def _renote_key(body: Notification) -> str | None:
+    if body.note is None or body.note.renote is None:
+        return None
+    return body.note.renote.id
+
+
+# 通知の種類ごとに、どのノートに対する通知としてまとめるかを決める関数
+GROUP_KEYS: dict[str, Callable[[Notification], str | None]] = {
+    "reaction": _note_key,
+    "renote": _renote_key,
+}
+
+
+def coalesce_key(event: Event) -> Hashable | None:
+    """
+    キューが溢れた時(overflow=coalesce)に置き換えてよい通知のキー
+    同じノートへの同じ種類のリアクション/リノート(まとめる時と同じキー)だけを置き換える
+    まとめた後の通知は件数が失われるので置き換えない
+
+    Returns:
+        Hashable | None: 置き換えない通知の場合はNone
+    """
+    if event.group is not None:
+        return None
+    group_key = GROUP_KEYS.get(event.body.type)
+    if group_key is None:
+        return None
+    note_id = group_key(event.body)
+    if note_id is None:
+        return None
+    return (event.account, event.body.type, note_id)
+
+
+class Group:
+    """まとめられた通知の情報"""
+
+    __slots__ = ("count", "bodies", "reactions")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.bodies: list[Notification] = []  # 新しいものが後ろ(max_users件まで)
+        self.reactions: dict[str, None] = {}  # 順序付きの集合として使う
+
+
+class _Bucket:
+    __slots__ = ("group", "first", "deadline", "handle")
+
+    def __init__(self, first: Event, deadline: float) -> None:
+        self.group = Group()
+        self.first = first
+        self.deadline = deadline
+        self.handle: asyncio.TimerHandle | None = None
+
+
+class Aggregator:
+    """
+    同じノートに対するリアクション/リノートを一定時間まとめて1件の通知にする
+
+    最初の通知からwindow秒以内に次の通知が来るたびに待ち時間を延長し
+    最初の通知からmax_delay秒経ったら必ず送り出す
+    """
+
+    def __init__(
+        self,
+        settings: dict[str, dict | bool],
+        max_users: int = 2,
+        max_reactions: int = 5,
+    ) -> None:
+        """
+        Args:
+            settings (dict): 通知の種類: {"window": 秒, "max_delay": 秒}
+                             falseまたは未指定の種類はまとめずにそのまま通知する
+            max_users (int, optional): 名前とアイコンのために保持する最新のユーザー数
+            max_reactions (int, optional): 保持するリアクションの種類数
+        """
+        self.settings = {
+            notify_type: value
+            for notify_type, value in settings.items()
+            if value and notify_type in GROUP_KEYS
+        }
+        self.max_users = max_users
+        self.max_reactions = max_reactions
+        self.emit: Callable[[Event], Awaitable[None]] | None = None
+        self._buckets: dict[tuple, _Bucket] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    def add(self, event: Event) -> bool:
+        """
+        通知をまとめる対象であれば保持する
+
+        Args:
+            event (Event): 通知のEvent
+
+        Returns:
+            bool: 保持した場合はTrue(後でemitされる), 対象外の場合はFalse
+        """
+        notify_type = event.body.type
+        setting = self.settings.get(notify_type)
+        if setting is None:
+            return False
+        note_id = GROUP_KEYS[notify_type](event.body)
+        if note_id is None:
+            return False
+
+        key = (event.account, notify_type, note_id)
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = _Bucket(event, now + setting.get("max_delay", 10))
+            self._buckets[key] = bucket
+        else:
+            bucket.handle.cancel()  # type: ignore[union-attr]
+
+        group = bucket.group
+        group.count += 1
+        group.bodies.append(event.body)
+        if len(group.bodies) > self.max_users:
+            del group.bodies[0]
+        reaction = event.body.reaction
+        if reaction is not None and len(group.reactions) < self.max_reactions:
+            group.reactions[reaction] = None
+
+        delay = min(setting.get("window", 3), bucket.deadline - now)
+        bucket.handle = asyncio.get_running_loop().call_later(
+            max(delay, 0), self._flush, key
+        )
+        return True
+
+    def _flush(self, key: tuple) -> None:
+        bucket = self._buckets.pop(key)
+        group = bucket.group
+        if group.count == 1:
+            event = bucket.first
+        else:
+            event = Event(
+                group.bodies[-1],
+                received_at=bucket.first.received_at,
+                account=bucket.first.account,
+            )
+            event.group = group
+            log_aggregator.info(f"{group.count} {key[1]} notifications aggregated")
+        if self.emit is not None:
+            task = asyncio.create_task(self.emit(event))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def flush_all(self) -> None:
+        """保持している通知をすべてすぐに送り出す"""
+        for key, bucket in list(self._buckets.items()):
+            bucket.handle.cancel()  # type: ignore[union-attr]
+            self._flush(key)
+
+    async def wait_emitted(self) -> None:
+        """送り出した通知が次の段のキューに入りきるまで待つ"""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def pending(self) -> int:
+        """まとめている途中のノートの数を返す(監視用)"""
+        return len(self._buckets)
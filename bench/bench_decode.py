@@ -0,0 +1,157 @@
+"""
+ストリーミングのフレームの解析の速度と、解析後に保持されるメモリの量を比べるマイクロベンチマーク
+
+legacy: json.loadsでdictにしてそのまま保持する(以前の処理)
+typed(json): notification.decode_frameで必要な項目だけを持つオブジェクトにする(標準のjson)
+typed(<backend>): 同じくorjson/msgspecがインストールされていればそれを使う
+
+使い方: python bench/bench_decode.py
+"""
+
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+from typing import Any, Callable
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import notification  # noqa: E402
+
+
+def user(n: int) -> dict:
+    """実際のMisskeyのUserLite程度の大きさのユーザー"""
+    return {
+        "id": f"9abc{n:08d}",
+        "name": f"ユーザー{n} :blobcat:",
+        "username": f"user{n}",
+        "host": "remote.example",
+        "avatarUrl": f"https://media.example/proxy/avatar.webp?url=https%3A%2F%2Fremote.example%2F{n}.png",
+        "avatarBlurhash": "eQFs:Z~qIU%2Rjj[WBoft7ay-;t7ofWBj[00WBWBfQayj[",
+        "avatarDecorations": [],
+        "isBot": False,
+        "isCat": True,
+        "instance": {
+            "name": "Remote Example",
+            "softwareName": "misskey",
+            "softwareVersion": "2024.5.0",
+            "iconUrl": "https://remote.example/favicon.ico",
+            "faviconUrl": "https://remote.example/favicon.ico",
+            "themeColor": "#86b300",
+        },
+        "emojis": {"blobcat": "https://remote.example/emoji/blobcat.png"},
+        "onlineStatus": "online",
+        "badgeRoles": [{"name": "Supporter", "iconUrl": None, "displayOrder": 0}],
+    }
+
+
+def note(n: int) -> dict:
+    return {
+        "id": f"9note{n:08d}",
+        "createdAt": "2024-05-01T00:00:00.000Z",
+        "userId": f"9abc{n:08d}",
+        "user": user(n),
+        "text": "今日のご飯 $[tada **カレー**] :blobcat: https://example.com/" * 3,
+        "cw": None,
+        "visibility": "public",
+        "localOnly": False,
+        "reactionAcceptance": None,
+        "renoteCount": 12,
+        "repliesCount": 3,
+        "reactionCount": 57,
+        "reactions": {":blobcat@.:": 20, "👍": 30, ":ablobcatwave@remote.example:": 7},
+        "reactionEmojis": {"ablobcatwave@remote.example": "https://remote.example/emoji/ablobcatwave.png"},
+        "emojis": {},
+        "fileIds": ["f1", "f2"],
+        "files": [
+            {
+                "id": f"f{i}",
+                "name": f"image{i}.jpg",
+                "type": "image/jpeg",
+                "md5": "d41d8cd98f00b204e9800998ecf8427e",
+                "size": 123456,
+                "isSensitive": False,
+                "blurhash": "eQFs:Z~qIU%2Rjj[WBoft7ay-;t7ofWBj[00WBWBfQayj[",
+                "properties": {"width": 1920, "height": 1080},
+                "url": f"https://media.example/files/{i}.jpg",
+                "thumbnailUrl": f"https://media.example/thumbnails/{i}.webp",
+            }
+            for i in range(2)
+        ],
+        "replyId": None,
+        "renoteId": None,
+        "clippedCount": 0,
+    }
+
+
+def notification_frame(n: int) -> str:
+    body = {
+        "id": f"9ntf{n:08d}",
+        "createdAt": "2024-05-01T00:00:00.000Z",
+        "type": "reaction",
+        "isRead": False,
+        "userId": f"9abc{n:08d}",
+        "user": user(n),
+        "note": note(n),
+        "reaction": ":blobcat@.:",
+    }
+    return json.dumps({"type": "channel", "body": {"id": "1", "type": "notification", "body": body}})
+
+
+OTHER_FRAME = json.dumps({"type": "channel", "body": {"id": "1", "type": "readAllNotifications"}})
+
+
+def legacy_decode(frame: str) -> Any:
+    """以前の処理(ペイロード全体をdictとして保持する)"""
+    recv = json.loads(frame)
+    if recv["type"] == "channel" and recv["body"]["type"] == "notification":
+        body = recv["body"]["body"]
+        body["note"]["text"], body["user"]["avatarUrl"]  # フォーマッタが読む項目
+        return body
+    return None
+
+
+def typed_decode(loads: Callable[[str], Any]) -> Callable[[str], Any]:
+    def decode(frame: str) -> Any:
+        notification.loads = loads
+        result = notification.decode_frame(frame)
+        if result is not None:
+            result.note.text, result.user.avatar_url
+        return result
+
+    return decode
+
+
+def retained_bytes(decode: Callable[[str], Any], frames: list[str]) -> float:
+    """解析結果を保持し続けた場合の1件あたりのメモリ(バイト)"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = [decode(frame) for frame in frames]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return (after - before) / len(frames)
+
+
+def main() -> None:
+    backend_loads = notification.loads
+    decoders = {"legacy": legacy_decode, "typed(json)": typed_decode(json.loads)}
+    if notification.JSON_BACKEND != "json":
+        decoders[f"typed({notification.JSON_BACKEND})"] = typed_decode(backend_loads)
+
+    frames = [notification_frame(n) for n in range(1000)]
+    print(f"frame size: {len(frames[0])} bytes")
+    print(f"{'decoder':<16}{'notification(us)':>18}{'other frame(us)':>18}{'retained(B/ntf)':>18}")
+    for name, decode in decoders.items():
+        number = 1000
+        # ばらつきを避けるため5回計測して最も速い値を使う
+        per_frame = min(timeit.repeat(lambda: decode(frames[0]), number=number, repeat=5)) / number * 1e6
+        other = min(timeit.repeat(lambda: decode(OTHER_FRAME), number=number, repeat=5)) / number * 1e6
+        retained = retained_bytes(decode, frames)
+        print(f"{name:<16}{per_frame:>18.2f}{other:>18.2f}{retained:>18.0f}")
+    notification.loads = backend_loads
+
+
+if __name__ == "__main__":
+    main()
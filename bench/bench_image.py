@@ -0,0 +1,67 @@
+"""
+ダウンロードした画像の保存にかかる時間と保存後の大きさを、以前の処理(元の形式/大きさのまま保存)と比べるベンチマーク
+
+使い方: python bench/bench_image.py
+"""
+
+import os
+import sys
+import tempfile
+import timeit
+from io import BytesIO
+
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from image_process import make_icon, sniff_format  # noqa: E402
+
+
+def legacy_save(data: bytes, data_dir: str) -> int:
+    """以前の処理(デコードして元の形式でそのまま保存する)"""
+    with BytesIO(data) as buf:
+        img = Image.open(buf)
+        path = os.path.join(data_dir, f"avatar.{img.format.lower()}")  # type: ignore
+        img.save(path, save_all=getattr(img, "is_animated", False))
+    return os.path.getsize(path)
+
+
+def sample(image_format: str, size: int, frames: int = 1) -> bytes:
+    images = [
+        Image.linear_gradient("L").resize((size, size)).convert("RGB").rotate(i * 10)
+        for i in range(frames)
+    ]
+    with BytesIO() as buf:
+        if frames > 1:
+            images[0].save(buf, format=image_format, save_all=True, append_images=images[1:])
+        else:
+            images[0].save(buf, format=image_format)
+        return buf.getvalue()
+
+
+CASES = {
+    "jpeg 1024px": sample("JPEG", 1024),
+    "png 400px": sample("PNG", 400),
+    "webp 400px": sample("WEBP", 400),
+    "gif 400px x30": sample("GIF", 400, 30),
+    "webp 400px x30": sample("WEBP", 400, 30),
+}
+
+
+def main() -> None:
+    print(f"{'case':<16}{'input(KB)':>10}{'legacy(ms)':>12}{'legacy(KB)':>12}{'icon(ms)':>10}{'icon(KB)':>10}{'sniff(us)':>11}")
+    with tempfile.TemporaryDirectory() as data_dir:
+        for name, data in CASES.items():
+            number = 5
+            legacy = min(timeit.repeat(lambda: legacy_save(data, data_dir), number=number, repeat=3))
+            icon = min(timeit.repeat(lambda: make_icon(data, 128), number=number, repeat=3))
+            sniff = min(timeit.repeat(lambda: sniff_format(data), number=1000, repeat=3))
+            print(
+                f"{name:<16}{len(data) / 1024:>10.1f}{legacy / number * 1000:>12.2f}"
+                f"{legacy_save(data, data_dir) / 1024:>12.1f}{icon / number * 1000:>10.2f}"
+                f"{len(make_icon(data, 128)) / 1024:>10.1f}{sniff / 1000 * 1e6:>11.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""
+text_render.render と、以前の正規表現によるメンション除去の速度を比べるマイクロベンチマーク
+
+使い方: python bench/bench_text_render.py
+"""
+
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from text_render import render  # noqa: E402
+
+
+def legacy_strip(text: str) -> str:
+    """以前のreply/mentionの処理(findallで数えてからsubする)"""
+    return re.sub(
+        pattern=r"(@.+@.+\..+\s)",
+        repl="",
+        string=text,
+        count=len(re.findall(pattern=r"(@.+@.+\..+\s)", string=text)),
+    )
+
+
+CASES = {
+    "short reply": "@alice@example.com こんにちは！今日もいい天気ですね :blobcat:",
+    "long note": "@alice@example.com @bob@example.net "
+    + "$[tada **長いノート**] [リンク](https://example.com) :blobcat@.: ~~打ち消し~~\n" * 200,
+    # 改行の無い長い行に@と.が多数含まれると、以前の正規表現は大量にバックトラックする
+    "adversarial @.": "@a@b." * 40 + "x",
+    "adversarial brackets": "[](" * 5000,
+}
+
+
+def main() -> None:
+    print(f"{'case':<22}{'chars':>8}{'legacy(ms)':>14}{'render(ms)':>14}{'render 200(ms)':>16}")
+    for name, text in CASES.items():
+        number = 5
+        legacy = timeit.timeit(lambda: legacy_strip(text), number=number) / number * 1000
+        new = timeit.timeit(lambda: render(text, strip_mentions=True), number=number) / number * 1000
+        cut = timeit.timeit(lambda: render(text, 200, strip_mentions=True), number=number) / number * 1000
+        print(f"{name:<22}{len(text):>8}{legacy:>14.3f}{new:>14.3f}{cut:>16.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+終了時にキューとまとめている途中の通知を送りきるか確かめる回帰テスト
+
+まとめる対象のリアクション/リノートを解析前のキューに溜めた状態でPipeline.stop(drain_timeout>0)を呼び
+全ての通知が(まとめられた上で)送信されることを確認する
+
+使い方: python bench/check_shutdown.py (失敗した場合は終了コード1)
+"""
+
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from aggregator import Aggregator  # noqa: E402
+from notification import Note, Notification, User  # noqa: E402
+from pipeline import Event, Pipeline  # noqa: E402
+
+
+async def check(count: int = 50, notes: int = 3) -> list[str]:
+    delivered: list[Event] = []
+
+    def parse(frame: Notification) -> Event:
+        return Event(frame, account="account")
+
+    async def enrich(event: Event) -> dict:
+        return {"event": event}
+
+    async def deliver(event: Event) -> None:
+        delivered.append(event)
+
+    pipeline = Pipeline(
+        parse=parse,
+        enrich=enrich,
+        deliver=deliver,
+        queue_size=count * 2,
+        stats_interval=0,
+        aggregator=Aggregator(
+            {"reaction": {"window": 60, "max_delay": 60}, "renote": {"window": 60, "max_delay": 60}}
+        ),
+    )
+    pipeline.start()
+    for n in range(count):
+        note = Note(f"note{n % notes}")
+        if n % 2:
+            body = Notification(f"r{n}", "reaction", User(f"user{n}"), note, reaction=":blobcat:")
+        else:
+            body = Notification(f"q{n}", "renote", User(f"user{n}"), Note(f"renote{n}", renote=note))
+        await pipeline.submit(body)
+    # 解析前のキューに残っている状態で止める
+    await pipeline.stop(drain_timeout=5)
+
+    failures = []
+    represented = sum(event.group.count if event.group is not None else 1 for event in delivered)
+    if represented != count:
+        failures.append(f"{count - represented} of {count} notifications were lost on shutdown")
+    if len(delivered) > notes * 2:
+        failures.append(f"{len(delivered)} notifications delivered (expected at most {notes * 2} groups)")
+    return failures
+
+
+def main() -> None:
+    failures = asyncio.run(check())
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+    print("OK: all notifications were delivered on shutdown")
+
+
+if __name__ == "__main__":
+    main()
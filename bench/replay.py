@@ -0,0 +1,409 @@
+"""
+ローカルのMisskeyの代わりのサーバーに通知を流して、受信から通知までを計測するベンチマーク
+
+ストリーミング(/streaming)とAPI(/api/*)、アイコン画像(/avatars/*)を返すサーバーを
+別スレッドで起動し、Clientをそこに接続させて、記録済みまたは合成した通知のフレームを
+指定したレートで送り付ける。OSの通知の代わりに記録用のsinkを使うので、ネットワークにも
+デスクトップにも依存せずCIで実行できる
+
+必要なもの: requirements.txtのパッケージ
+
+使い方:
+    python bench/replay.py --rate 200 --count 2000
+    python bench/replay.py --frames recorded.jsonl --rate 50
+    python bench/replay.py --ci --max-p99-ms 500 --min-throughput 100 --max-memory-mb 50
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from io import BytesIO
+from typing import Any
+
+from aiohttp import WSMsgType, web
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import metrics  # noqa: E402
+from client import Client  # noqa: E402
+from pipeline import Event  # noqa: E402
+
+APP_ICON = os.path.join(os.path.dirname(__file__), "..", "icon", "icon.png")
+
+# 合成する通知の種類と割合
+TYPE_WEIGHTS = {
+    "reaction": 50,
+    "renote": 10,
+    "mention": 15,
+    "reply": 10,
+    "follow": 10,
+    "quote": 5,
+}
+REACTIONS = ("👍", "🎉", ":blobcat@.:", ":ablobcatwave@misskey.example:", "❤")
+
+
+def synthetic_frames(count: int, base_url: str, users: int = 200, hot_notes: int = 5) -> list[str]:
+    """
+    通知のフレームを合成する
+    リアクション/リノートは少数のノートに集中させ、バズった時の状態を再現する
+    """
+    rng = random.Random(0)
+    user_pool = [
+        {
+            "id": f"user{n}",
+            "name": f"ユーザー{n}" if n % 3 else None,
+            "username": f"user{n}",
+            "host": None if n % 2 else "remote.example",
+            "avatarUrl": f"{base_url}/avatars/user{n}.png",
+        }
+        for n in range(users)
+    ]
+    text = "@me@local.example $[tada **テスト**] [リンク](https://example.com) :blobcat: " * 3
+    types = list(TYPE_WEIGHTS)
+    weights = list(TYPE_WEIGHTS.values())
+    frames = []
+    for n in range(count):
+        notify_type = rng.choices(types, weights)[0]
+        user = rng.choice(user_pool)
+        note_id = f"note{rng.randrange(hot_notes)}"
+        body = {"id": f"{n:012d}", "type": notify_type, "user": user, "userId": user["id"]}
+        if notify_type == "reaction":
+            body["reaction"] = rng.choice(REACTIONS)
+            body["note"] = {
+                "id": note_id,
+                "text": text,
+                "reactionEmojis": {"ablobcatwave@misskey.example": f"{base_url}/emoji/ablobcatwave.png"},
+            }
+        elif notify_type == "renote":
+            body["note"] = {"id": f"renote{n}", "text": None, "renote": {"id": note_id, "text": text}}
+        elif notify_type in ("mention", "reply"):
+            body["note"] = {"id": f"n{n}", "text": text, "reply": {"id": note_id, "text": text}}
+        elif notify_type == "quote":
+            body["note"] = {"id": f"n{n}", "text": text, "renote": {"id": note_id, "text": text}}
+        # MisskeyのJSON.stringifyと同じく空白無しで出す
+        frames.append(
+            json.dumps(
+                {"type": "channel", "body": {"id": "1", "type": "notification", "body": body}},
+                ensure_ascii=False,
+                separators=(",", ":"),
+            )
+        )
+    return frames
+
+
+def avatar_png() -> bytes:
+    with BytesIO() as buf:
+        Image.new("RGB", (96, 96), (134, 179, 0)).save(buf, format="PNG")
+        return buf.getvalue()
+
+
+class StandInServer:
+    """Misskeyの代わりのサーバー(別スレッドのイベントループで動く)"""
+
+    def __init__(self, frames: list[str], rate: float) -> None:
+        self.frames = frames
+        self.rate = rate
+        self.avatar = avatar_png()
+        self.image_requests = 0
+        self.sent = 0
+        self.finished = threading.Event()
+        self.port: int | None = None
+        self._ready = threading.Event()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> int:
+        self._thread.start()
+        self._ready.wait()
+        return self.port  # type: ignore[return-value]
+
+    def stop(self) -> None:
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)
+
+    def _run(self) -> None:
+        self._loop = asyncio.new_event_loop()
+        app = web.Application()
+        app.router.add_get("/", self._index)
+        app.router.add_get("/streaming", self._streaming)
+        app.router.add_get("/avatars/{name}", self._avatar)
+        app.router.add_get("/emoji/{name}", self._avatar)
+        app.router.add_get("/api/emojis", self._emojis)
+        app.router.add_post("/api/{endpoint:.*}", self._api)
+        runner = web.AppRunner(app, access_log=None)
+        self._loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        self._loop.run_until_complete(site.start())
+        self.port = site._server.sockets[0].getsockname()[1]  # type: ignore[union-attr]
+        self._ready.set()
+        self._loop.run_forever()
+        self._loop.run_until_complete(runner.cleanup())
+
+    async def _index(self, request: web.Request) -> web.Response:
+        return web.Response(text="ok")
+
+    async def _avatar(self, request: web.Request) -> web.Response:
+        self.image_requests += 1
+        etag = '"avatar"'
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304)
+        return web.Response(body=self.avatar, content_type="image/png", headers={"ETag": etag})
+
+    async def _emojis(self, request: web.Request) -> web.Response:
+        base_url = f"http://{request.host}"
+        return web.json_response(
+            {"emojis": [{"name": "blobcat", "url": f"{base_url}/emoji/blobcat.png"}]},
+            headers={"ETag": '"emojis"'},
+        )
+
+    async def _api(self, request: web.Request) -> web.Response:
+        endpoint = request.match_info["endpoint"]
+        if endpoint == "i":
+            return web.json_response({"id": "me", "username": "me", "name": "me"})
+        if endpoint == "i/notifications":
+            return web.json_response([])
+        if endpoint == "notifications/mark-all-as-read":
+            return web.Response(status=204)
+        return web.json_response({})
+
+    async def _streaming(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        msg = await ws.receive()  # チャンネル接続のペイロード
+        if msg.type != WSMsgType.TEXT:
+            return ws
+        reader = asyncio.create_task(self._read(ws))
+        interval = 1 / self.rate if self.rate > 0 else 0
+        started = time.perf_counter()
+        for n, frame in enumerate(self.frames):
+            if interval:
+                delay = started + n * interval - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await ws.send_str(frame)
+            self.sent += 1
+        self.finished.set()
+        await reader  # クライアントが切断するまで接続を保つ
+        return ws
+
+    async def _read(self, ws: web.WebSocketResponse) -> None:
+        """クライアントからのメッセージを読む(pingにはpongを返す)"""
+        async for msg in ws:
+            if msg.type == WSMsgType.TEXT and msg.data == "ping":
+                await ws.send_str("pong")
+
+
+class RecordingSink:
+    """OSの通知の代わりに届いた通知と遅延を記録する"""
+
+    def __init__(self, delay: float = 0) -> None:
+        self.delay = delay
+        self.delivered = 0
+        self.latencies: list[float] = []  # まとめられていない通知の遅延
+        self.grouped_latencies: list[float] = []  # まとめられた通知の遅延(まとめる時間を含む)
+        self.types: Counter[str] = Counter()
+        self.represented: Counter[str] = Counter()  # まとめられた分も含めた通知の数
+
+    async def deliver(self, title: str, content: str, img: str, **meta: Any) -> None:
+        if self.delay:
+            await asyncio.to_thread(time.sleep, self.delay)
+        self.delivered += 1
+
+    def on_delivered(self, event: Event, latency: float) -> None:
+        notify_type = event.body.type
+        self.types[notify_type] += 1
+        if event.group is not None:
+            self.grouped_latencies.append(latency)
+            self.represented[notify_type] += event.group.count
+        else:
+            self.latencies.append(latency)
+            self.represented[notify_type] += 1
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+async def run(args: argparse.Namespace) -> dict:
+    if args.frames:
+        with open(args.frames, mode="r", encoding="UTF-8") as f:
+            recorded = [line.strip() for line in f if line.strip()]
+    else:
+        recorded = None
+
+    server = StandInServer([], args.rate)
+    port = server.start()
+    base_url = f"http://127.0.0.1:{port}"
+    server.frames = recorded if recorded is not None else synthetic_frames(args.count, base_url)
+
+    config = {
+        "accounts": [{"host": f"127.0.0.1:{port}", "i": "token", "scheme": "http"}],
+        "request_timeout": 5,
+        "ws_reconnect_limit": 3,
+        "queue_size": args.queue_size,
+        "queue_overflow": args.overflow,
+        "queue_stats_interval": 0,
+        "aggregate": {}
+        if args.no_aggregate
+        else {
+            "reaction": {"window": args.window, "max_delay": args.window * 4},
+            "renote": {"window": args.window, "max_delay": args.window * 4},
+        },
+    }
+    sink = RecordingSink(args.sink_delay_ms / 1000)
+
+    tracemalloc.start()
+    with tempfile.TemporaryDirectory() as data_dir:
+        client = Client(
+            config,
+            deliver=sink.deliver,
+            app_icon=APP_ICON,
+            data_dir=data_dir,
+            on_delivered=sink.on_delivered,
+        )
+        memory_before = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        client.start()
+
+        # 全て送信し終わり、パイプラインが空になるまで待つ
+        await asyncio.to_thread(server.finished.wait, args.timeout)
+        idle_since = None
+        deadline = time.perf_counter() + args.timeout
+        while time.perf_counter() < deadline:
+            busy = any(client.pipeline.depths().values()) or client.pipeline.aggregator.pending()
+            if busy:
+                idle_since = None
+            elif idle_since is None:
+                idle_since = time.perf_counter()
+            elif time.perf_counter() - idle_since > 0.5:
+                break
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - started - 0.5
+        memory_after, memory_peak = tracemalloc.get_traced_memory()
+
+        client.cancel()
+        await client.close()
+        cache = client.image_cache
+    tracemalloc.stop()
+    server.stop()
+
+    lookups = cache.hits + cache.misses
+    report = {
+        "frames_sent": server.sent,
+        "notifications_delivered": sink.delivered,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_per_s": round(sum(sink.represented.values()) / elapsed, 1) if elapsed > 0 else 0,
+        "per_type": {
+            notify_type: {
+                "delivered": sink.types[notify_type],
+                "represented": sink.represented[notify_type],
+                "per_s": round(sink.represented[notify_type] / elapsed, 1) if elapsed > 0 else 0,
+            }
+            for notify_type in sorted(sink.types)
+        },
+        "latency_ms": {
+            "p50": round(percentile(sink.latencies, 50) * 1000, 2),
+            "p99": round(percentile(sink.latencies, 99) * 1000, 2),
+            "max": round(max(sink.latencies, default=0) * 1000, 2),
+        },
+        "grouped_latency_ms": {
+            "p50": round(percentile(sink.grouped_latencies, 50) * 1000, 2),
+            "p99": round(percentile(sink.grouped_latencies, 99) * 1000, 2),
+            "max": round(max(sink.grouped_latencies, default=0) * 1000, 2),
+        },
+        "memory_growth_mb": round((memory_after - memory_before) / 1024 / 1024, 2),
+        "memory_peak_mb": round(memory_peak / 1024 / 1024, 2),
+        "image_cache": {
+            "hits": cache.hits,
+            "misses": cache.misses,
+            "hit_rate": round(cache.hits / lookups, 3) if lookups else 0,
+            "image_requests": server.image_requests,
+        },
+        "http": {
+            "handshakes": metrics.HANDSHAKES.total(),
+            "reused": metrics.CONNECTIONS_REUSED.total(),
+        },
+        "dropped": {queue: stats["dropped"] for queue, stats in client.pipeline.stats().items()},
+    }
+    return report
+
+
+def print_report(report: dict) -> None:
+    print(f"frames sent           : {report['frames_sent']}")
+    print(f"notifications shown   : {report['notifications_delivered']}")
+    print(f"elapsed               : {report['elapsed_s']}s")
+    print(f"throughput            : {report['throughput_per_s']}/s")
+    for notify_type, stats in report["per_type"].items():
+        print(
+            f"  {notify_type:<12} shown {stats['delivered']:>6}  "
+            f"represented {stats['represented']:>6}  {stats['per_s']:>8}/s"
+        )
+    latency = report["latency_ms"]
+    print(f"latency               : p50 {latency['p50']}ms  p99 {latency['p99']}ms  max {latency['max']}ms")
+    grouped = report["grouped_latency_ms"]
+    print(f"latency (grouped)     : p50 {grouped['p50']}ms  p99 {grouped['p99']}ms  max {grouped['max']}ms")
+    print(f"memory                : growth {report['memory_growth_mb']}MB  peak {report['memory_peak_mb']}MB")
+    cache = report["image_cache"]
+    print(
+        f"image cache           : hit rate {cache['hit_rate']:.1%} "
+        f"({cache['hits']} hits, {cache['misses']} misses, {cache['image_requests']} image requests)"
+    )
+    http = report["http"]
+    print(f"http connections      : {http['handshakes']:g} handshakes, {http['reused']:g} reused")
+    print(f"dropped               : {report['dropped']}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--frames", help="記録したフレームのJSON Lines(1行に1フレーム)")
+    parser.add_argument("--count", type=int, default=2000, help="合成するフレームの数")
+    parser.add_argument("--rate", type=float, default=200, help="1秒あたりに送るフレームの数(0で全力)")
+    parser.add_argument("--queue-size", type=int, default=100)
+    parser.add_argument("--overflow", default="drop_oldest")
+    parser.add_argument("--window", type=float, default=0.2, help="まとめる時間(秒)")
+    parser.add_argument("--no-aggregate", action="store_true", help="通知をまとめない")
+    parser.add_argument("--sink-delay-ms", type=float, default=0, help="通知1件にかかる時間の模擬")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--json", action="store_true", help="結果をJSONで出力する")
+    parser.add_argument("--ci", action="store_true", help="しきい値を超えた場合に終了コード1で終わる")
+    parser.add_argument("--max-p99-ms", type=float, default=500, help="まとめられていない通知のp99遅延の上限")
+    parser.add_argument("--min-throughput", type=float, default=0)
+    parser.add_argument("--max-memory-mb", type=float, default=50)
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+
+    if args.ci:
+        failures = []
+        if report["latency_ms"]["p99"] > args.max_p99_ms:
+            failures.append(f"p99 latency {report['latency_ms']['p99']}ms > {args.max_p99_ms}ms")
+        if report["throughput_per_s"] < args.min_throughput:
+            failures.append(f"throughput {report['throughput_per_s']}/s < {args.min_throughput}/s")
+        if report["memory_growth_mb"] > args.max_memory_mb:
+            failures.append(f"memory growth {report['memory_growth_mb']}MB > {args.max_memory_mb}MB")
+        if report["notifications_delivered"] == 0:
+            failures.append("no notification was delivered")
+        for failure in failures:
+            print(f"FAIL: {failure}", file=sys.stderr)
+        sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,403 @@
+import asyncio
+import logging
+import os
+from typing import Awaitable, Callable
+
+import metrics
+from account import Account, AccountError
+from aggregator import Aggregator, coalesce_key
+from formatters import FormatterRegistry
+from http_client import HttpClient
+from image_cache import ImageCache
+from image_process import ImageProcessor
+from image_store import ImageStore
+from log_setup import PayloadCapture
+from notification import User, decode_channel_note, decode_frame
+from pipeline import Event, Pipeline
+from sinks import SinkDispatcher, build_sinks
+from streaming import Channel
+
+log_main = logging.getLogger("main")
+log_img = logging.getLogger("img_get")
+
+DEFAULT_AGGREGATE = {
+    "reaction": {"window": 3, "max_delay": 10},
+    "renote": {"window": 3, "max_delay": 10},
+}
+
+
+class Client:
+    """
+    アカウントの接続、パイプライン、画像キャッシュ、フォーマッタをまとめたもの
+
+    通知の送信先(sinksまたはdeliver)だけを外から受け取るので、トレイアイコンやOSの通知が無い環境
+    (ヘッドレスでの起動やリプレイ用のベンチマークなど)からもそのまま使える
+    """
+
+    def __init__(
+        self,
+        config: dict,
+        deliver: Callable[..., Awaitable[None]] | None = None,
+        sinks: list[dict] | None = None,
+        app_name: str = "Misskey-Notify-Client",
+        app_icon: str = "icon/icon.png",
+        data_dir: str = ".data",
+        started_at: float | None = None,
+        on_all_stopped: Callable[[], None] | None = None,
+        on_delivered: Callable[[Event, float], None] | None = None,
+    ) -> None:
+        """
+        Args:
+            config (dict): config.jsonの設定(accountsを含む)
+            deliver (Callable | None, optional): 通知を送信するコルーチン関数(title, content, imgと付加情報を受け取る)
+                                                Noneの場合はsinksの送信先に送る
+            sinks (list[dict] | None, optional): 送信先の設定(Noneの場合はconfigのsinks, それも無ければOSの通知)
+            app_name (str, optional): 接続状態の通知に使うタイトル
+            app_icon (str, optional): 画像が無い場合に使うアイコンのパス
+            data_dir (str, optional): 画像やキャッシュを保存するフォルダ
+            started_at (float | None, optional): 起動した時刻(time.perf_counter), 起動時間のログ用
+            on_all_stopped (Callable | None, optional): 全てのアカウントが止まった時に呼び出す関数
+            on_delivered (Callable | None, optional): 通知を送信した後に(Event, 受信からの秒数)で呼び出す関数
+                                                      (sinksを使う場合はsinkのキューに入れた後)
+        """
+        self.config = config
+        self.app_name = app_name
+        self.app_icon = app_icon
+        self.on_all_stopped = on_all_stopped
+        self.paused = False  # 一時停止中は届いた通知を表示せずに数えるだけにする
+        self.paused_count = 0
+
+        # 画像保存用のフォルダが存在しない場合作成するように
+        if not os.path.exists(data_dir):
+            os.mkdir(data_dir)
+            log_main.info(f"Create '{data_dir}' directory")
+
+        # 全アカウントのAPIと画像のダウンロードで共有するHTTPクライアント(コネクションプール)
+        self.http = HttpClient(
+            timeout=config["request_timeout"],
+            limit=config.get("http_max_connections", 32),
+            limit_per_host=config.get("http_max_connections_per_host", 8),
+            dns_ttl=config.get("dns_cache_ttl", 300),
+        )
+
+        # 通知の送信先(sinkごとに専用のキューとワーカーを持ち、並行して送る)
+        self.sinks: SinkDispatcher | None = None
+        if deliver is None:
+            if sinks is None:
+                sinks = config.get("sinks") or [{"type": "desktop"}]
+            self.sinks = build_sinks(sinks, self.http)
+            deliver = self.sinks.deliver
+        self.deliver = deliver
+
+        # 画像のインデックスを開く(旧形式の.data/hash.jsonがあればここで移行される)
+        self.image_store = ImageStore(
+            data_dir=data_dir,
+            max_bytes=config.get("image_cache_max_mb", 100) * 1024 * 1024,
+            max_entries=config.get("image_cache_max_entries", 2000),
+        )
+        self.image_store.open()
+        self.image_cache = ImageCache(
+            store=self.image_store,
+            http=self.http,
+            processor=ImageProcessor(
+                size=config.get("icon_size", 128), workers=config.get("image_workers", 2)
+            ),
+            ttl=config.get("image_cache_ttl", 3600),
+            fallback=app_icon,
+        )
+
+        self.accounts = [
+            Account(
+                host=account_config["host"],
+                token=account_config["i"],
+                http=self.http,
+                settings=config,
+                label=account_config.get("name"),
+                scheme=account_config.get("scheme", "https"),
+                data_dir=data_dir,
+                started_at=started_at,
+                channels=account_config.get("channels"),
+            )
+            for account_config in config["accounts"]
+        ]
+
+        # DEBUGの時に受信したペイロードをログに残す割合と長さ
+        self.payload_capture = PayloadCapture(
+            sample_rate=config.get("log_payload_sample_rate", 0.1),
+            max_bytes=config.get("log_payload_max_bytes", 1024),
+        )
+
+        # 通知の種類ごとのフォーマッタ(起動時に1度だけ作る)
+        self.formatters = FormatterRegistry(config)
+        self.formatters.load_plugins()
+
+        self.pipeline = Pipeline(
+            parse=self.parse_frame,
+            enrich=self.enrich,
+            deliver=deliver,
+            queue_size=config.get("queue_size", 100),
+            overflow=config.get("queue_overflow", "drop_oldest"),
+            enrich_workers=config.get("enrich_workers", 4),
+            event_key=coalesce_key,
+            stats_interval=config.get("queue_stats_interval", 60),
+            aggregator=Aggregator(config.get("aggregate", DEFAULT_AGGREGATE)),
+            accept=self.accept,
+            on_delivered=on_delivered,
+        )
+        self.websocket_tasks: list[asyncio.Task] = []
+        self.bootstrap_tasks: list[asyncio.Task] = []
+        self.metrics_tasks: list[asyncio.Task] = []
+        self.emoji_tasks: list[asyncio.Task] = []
+        # 通知の画像を使う送信先が無い場合はアイコンも絵文字の画像も取得しない
+        self.images = self.sinks is None or self.sinks.uses_image
+        # カスタム絵文字のリアクションのアイコンに絵文字の画像を使うかどうか
+        self.emoji_icon = self.images and config.get("reaction_icon", "emoji") == "emoji"
+        # 計測結果のエンドポイント(metrics_portを設定した場合のみ)
+        self.metrics_server = (
+            metrics.MetricsServer(config.get("metrics_host", "127.0.0.1"), config["metrics_port"])
+            if config.get("metrics_port")
+            else None
+        )
+
+    async def get_image(self, url: str | User | None, name: str | None = None) -> str:
+        """
+        通知に使用する画像のパスを返す関数
+        キャッシュに存在する場合はそのまま返し(必要に応じてバックグラウンドで再検証)
+        存在しない場合はダウンロードしてからパスを返す
+
+        Args:
+            url (str | User | None): 確認する画像のURL
+                                ユーザーのアイコンの場合は通知のuser(User)をそのまま突っ込む
+                                アプリのアイコンの場合は画像のURL(str)をそのまま突っ込む
+            name (str | None, optional): アプリの画像を確認する場合にアプリ名を突っ込む
+                                                ユーザーのアイコン確認の際は無視して可
+
+        Returns:
+            image_path str: 画像のパス
+        """
+
+        log_img.info("get_image called")
+
+        # 引数urlがUserかどうか(指定されているのがユーザーのアイコンなのか)を判断
+        if isinstance(url, User):
+            log_img.debug("url is user")
+            name = url.id  # 画像保存時の名前用にuidを格納
+            url = url.avatar_url  # 引数から画像URLを取得し再格納
+        if name is None:
+            return self.app_icon
+        return await self.image_cache.get(url, name)
+
+    def parse_frame(self, item: tuple[Account, Channel, str | bytes]) -> Event | None:
+        """
+        受信したフレームを解析して通知のEventにする関数
+
+        Args:
+            item (tuple[Account, Channel, str | bytes]): 受信したアカウント、チャンネルと受信したフレーム
+
+        Returns:
+            Event | None: 通知以外のフレームの場合はNone
+        """
+        account, channel, frame = item
+        main_channel = channel.name == "main"
+        with metrics.FRAME_DECODE.time():
+            if main_channel:
+                notification = decode_frame(frame)
+            else:  # アンテナ/リストなどのチャンネルはノートを通知にする
+                notification = decode_channel_note(frame, channel.label)
+        log_main.info(f"[{account.label}] payload received")
+        payload = self.payload_capture.capture(log_main, frame)
+        if payload is not None:
+            log_main.debug(f"[{account.label}] payload: {payload}")  # デバッグ用
+        if notification is None:
+            return None
+        metrics.NOTIFICATIONS.inc(type=notification.type)
+        if not (account.accept(notification) if main_channel else account.accept_note(notification)):
+            return None
+        event = Event(notification, account=account)
+        if (
+            self.emoji_icon
+            and notification.type == "reaction"
+            and not self.paused
+            and self.formatters.is_enabled(event)
+        ):
+            # まとめる時間やキューで待っている間に絵文字の画像を取得しておく
+            # (通知しない種類や一時停止中は画像を取得しない)
+            emoji = account.emojis.resolve(notification)
+            if emoji is not None:
+                self.image_cache.prefetch(*emoji)
+        return event
+
+    async def enrich(self, event: Event) -> dict | None:
+        """
+        フォーマッタで通知を組み立てて画像を取得する関数
+        複数アカウントの場合はどのアカウントの通知かをタイトルに付ける
+
+        Args:
+            event (Event): 通知のEvent
+
+        Returns:
+            dict | None: deliverに渡す引数(通知しない場合はNone)
+        """
+        formatted = self.formatters.format(event)
+        if formatted is None:
+            return None
+        title = formatted.title
+        if len(self.accounts) > 1:
+            title = f"[{event.account.label}] {title}"
+        return dict(
+            title=title,
+            content=formatted.content,
+            img=await self.get_image(formatted.image, formatted.image_name) if self.images else self.app_icon,
+            # JSONで送るsink向けの付加情報(OSの通知では使わない)
+            type=event.body.type,
+            account=event.account.label,
+            id=event.body.id,
+            count=event.group.count if event.group is not None else 1,
+            received_at=event.received_at,  # sinkごとの遅延の計測用(sinkには送らない)
+        )
+
+    def accept(self, event: Event) -> bool:
+        """通知する種類で、一時停止中でなければTrueを返す"""
+        if not self.formatters.is_enabled(event):
+            return False
+        if self.paused:
+            self.paused_count += 1
+            return False
+        return True
+
+    def status_title(self, account: Account) -> str:
+        """接続状態などアプリからの通知のタイトル"""
+        if len(self.accounts) == 1:
+            return self.app_name
+        return f"[{account.label}] {self.app_name}"
+
+    async def bootstrap_account(self, account: Account, websocket_task: asyncio.Task) -> None:
+        """
+        アカウントの起動時の確認を行い、問題があった場合はそのアカウントの接続を止める関数
+        全てのアカウントが止まった場合はon_all_stoppedを呼び出す
+
+        Args:
+            account (Account): 確認するアカウント
+            websocket_task (asyncio.Task): そのアカウントのストリーミング接続のタスク
+        """
+        try:
+            await account.bootstrap()
+        except AccountError as e:
+            print(f"[{account.label}] {e.message}")
+            log_main.critical(f"[{account.label}] {e.log_message}")
+            websocket_task.cancel()
+            stopped = all(task.done() or task.cancelling() for task in self.websocket_tasks)
+            if stopped and self.on_all_stopped is not None:
+                self.on_all_stopped()
+
+    async def notify_status(self, account: Account | None, content: str) -> None:
+        """接続状態などアプリからの通知を送信する(一時停止中でも送信する)"""
+        title = self.app_name if account is None else self.status_title(account)
+        await self.deliver(
+            title=title,
+            content=content,
+            img=self.app_icon,
+            type="status",
+            account=None if account is None else account.label,
+        )
+
+    async def mark_all_as_read(self, account: Account) -> None:
+        """アカウントの通知をすべて既読にして結果を通知する"""
+        if await account.mark_all_as_read():
+            await self.notify_status(account, "通知をすべて既読にしました")
+        else:
+            await self.notify_status(account, "通知の既読化に失敗しました")
+
+    async def reconnect(self, account: Account | None = None) -> None:
+        """
+        今すぐ再接続する(再接続の上限に達して止まっていたアカウントは接続し直す)
+
+        Args:
+            account (Account | None, optional): 再接続するアカウント(Noneの場合は全アカウント)
+        """
+        for i, target in enumerate(self.accounts):
+            if account is not None and target is not account:
+                continue
+            task = self.websocket_tasks[i]
+            if task.done() and not task.cancelled():
+                self.websocket_tasks[i] = self._connect(target)
+            else:
+                await target.reconnect()
+
+    def pause(self) -> None:
+        """通知を一時停止する(受信とキャッチアップは続ける)"""
+        self.paused = True
+        self.paused_count = 0
+        log_main.info("notifications paused")
+
+    async def resume(self) -> None:
+        """通知を再開して、一時停止中に届いた通知の数を知らせる"""
+        self.paused = False
+        log_main.info(f"notifications resumed ({self.paused_count} skipped)")
+        if self.paused_count:
+            await self.notify_status(None, f"一時停止中に{self.paused_count}件の通知がありました")
+
+    def _connect(self, account: Account) -> asyncio.Task:
+        async def notify_status(content: str) -> None:
+            await self.notify_status(account, content)
+
+        return asyncio.create_task(account.websocket_connect(self.pipeline, notify_status))
+
+    def start(self) -> None:
+        """送信先、パイプラインと全アカウントの接続を開始する"""
+        if self.sinks is not None:
+            self.sinks.start()
+        self.pipeline.start()
+        log_main.info("Start pipeline")
+        summary_interval = self.config.get("metrics_summary_interval", 300)
+        if summary_interval > 0:
+            self.metrics_tasks.append(asyncio.create_task(metrics.summary_worker(summary_interval)))
+        if self.metrics_server is not None:
+            self.metrics_tasks.append(asyncio.create_task(self.metrics_server.start()))
+        for account in self.accounts:
+            websocket_task = self._connect(account)
+            self.websocket_tasks.append(websocket_task)
+            if self.emoji_icon:
+                self.emoji_tasks.append(
+                    asyncio.create_task(
+                        account.emojis.run(self.config.get("emoji_refresh_interval", 3600))
+                    )
+                )
+            # 生存確認やプロフィールの取得は接続を待たせずに並行して行う
+            self.bootstrap_tasks.append(
+                asyncio.create_task(self.bootstrap_account(account, websocket_task))
+            )
+        log_main.info(f"Start websocket task ({len(self.accounts)} accounts)")
+
+    async def wait(self) -> None:
+        """全アカウントの接続が終わるまで待つ(待っている間に接続し直したものも待つ)"""
+        while True:
+            await asyncio.gather(*self.websocket_tasks, return_exceptions=True)
+            if all(task.done() for task in self.websocket_tasks):
+                return
+
+    def cancel(self) -> None:
+        """全アカウントの接続を止める"""
+        for task in self.websocket_tasks + self.bootstrap_tasks + self.emoji_tasks:
+            task.cancel()
+
+    async def close(self, drain_timeout: float = 0) -> None:
+        """
+        パイプラインと送信先を止めて画像のインデックスを書き込む
+
+        Args:
+            drain_timeout (float, optional): 残っている通知を処理しきるまで待つ時間(秒)
+                                             パイプラインと送信先のキューでそれぞれ待つ
+        """
+        await self.pipeline.stop(drain_timeout)
+        if self.sinks is not None:
+            await self.sinks.close(drain_timeout)
+        for task in self.metrics_tasks:
+            task.cancel()
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
+        metrics.log_metrics.info(metrics.summary())
+        await self.http.close()
+        self.image_cache.processor.close()
+        await self.image_store.wait_writes()
+        self.image_store.close()
@@ -0,0 +1,81 @@
+import asyncio
+import logging
+from concurrent.futures import Future
+from typing import Callable, Coroutine
+
+from account import Account
+from client import Client
+
+log_main = logging.getLogger("main")
+
+
+class CommandBridge:
+    """
+    トレイのメニュー(pystrayのスレッド)からイベントループに処理を頼むための窓口
+
+    処理はrun_coroutine_threadsafeでイベントループに渡すだけなので
+    メニューのクリックがトレイのUIや受信を止めることは無い
+    """
+
+    def __init__(
+        self,
+        client: Client,
+        loop: asyncio.AbstractEventLoop,
+        on_shutdown: Callable[[], None] | None = None,
+    ) -> None:
+        """
+        Args:
+            client (Client): 操作するClient
+            loop (asyncio.AbstractEventLoop): Clientが動いているイベントループ
+            on_shutdown (Callable | None, optional): 終了する時にイベントループで呼び出す関数(トレイを閉じるなど)
+        """
+        self.client = client
+        self.loop = loop
+        self.on_shutdown = on_shutdown
+
+    def submit(self, coro: Coroutine) -> Future:
+        """
+        コルーチンをイベントループで実行する(どのスレッドからでも呼び出せる)
+
+        Returns:
+            Future: 完了を待つ必要は無い(失敗した場合はログに出す)
+        """
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        future.add_done_callback(self._log_failure)
+        return future
+
+    @staticmethod
+    def _log_failure(future: Future) -> None:
+        if not future.cancelled() and future.exception() is not None:
+            log_main.error("command failed", exc_info=future.exception())
+
+    def mark_read(self, account: Account) -> Future:
+        """通知をすべて既読にする"""
+        return self.submit(self.client.mark_all_as_read(account))
+
+    def reconnect(self, account: Account | None = None) -> Future:
+        """今すぐ再接続する(Noneの場合は全アカウント)"""
+        return self.submit(self.client.reconnect(account))
+
+    def toggle_pause(self) -> Future:
+        """通知の一時停止/再開を切り替える"""
+        return self.submit(self._toggle_pause())
+
+    async def _toggle_pause(self) -> None:
+        if self.client.paused:
+            await self.client.resume()
+        else:
+            self.client.pause()
+
+    def shutdown(self) -> Future:
+        """
+        終了する
+        受信を止めた後、キューに残っている通知はClient.closeで処理しきってから終わる
+        """
+        return self.submit(self._shutdown())
+
+    async def _shutdown(self) -> None:
+        log_main.info("shutdown requested")
+        self.client.cancel()
+        if self.on_shutdown is not None:
+            self.on_shutdown()
@@ -0,0 +1,169 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from http_client import ApiError, HttpClient
+from notification import Notification, loads
+
+log_emoji = logging.getLogger("emoji")
+
+_UNSAFE = re.compile(r"[^A-Za-z0-9_.+-]")
+
+
+def parse_reaction(reaction: str | None) -> tuple[str, str | None] | None:
+    """
+    リアクションがカスタム絵文字の場合は(名前, ホスト)を返す
+
+    :name: と :name@.: はローカルの絵文字(ホストはNone)
+
+    Returns:
+        tuple[str, str | None] | None: Unicodeの絵文字の場合はNone
+    """
+    if not reaction or len(reaction) < 3 or reaction[0] != ":" or reaction[-1] != ":":
+        return None
+    name, _, host = reaction[1:-1].partition("@")
+    return name, None if host in ("", ".") else host
+
+
+def image_name(instance: str, name: str, host: str | None) -> str:
+    """
+    絵文字の画像をキャッシュに保存する時の名前(ファイル名に使えない文字は_にする)
+    同じ名前の絵文字でもインスタンスごとに画像が違うので、受け取ったインスタンスのホストを含める
+
+    Args:
+        instance (str): 通知を受け取ったインスタンスのホスト
+        name (str): 絵文字の名前
+        host (str | None): リモートの絵文字の場合はそのホスト(ローカルの場合はNone)
+    """
+    return _UNSAFE.sub("_", f"emoji_{instance}_{host or 'local'}_{name}")
+
+
+class EmojiCatalog:
+    """
+    インスタンスのカスタム絵文字の一覧(名前: 画像のURL)
+
+    一覧は/api/emojisから取得してディスクに保存し、起動直後からすぐに引けるようにする
+    バックグラウンドで定期的に取得し直すが、ETagで変更が無ければ一覧の受信も保存もしない
+    """
+
+    def __init__(self, http: HttpClient, base_url: str, path: str) -> None:
+        """
+        Args:
+            http (HttpClient): 共有するHTTPクライアント
+            base_url (str): インスタンスのURL
+            path (str): 一覧を保存するファイルのパス
+        """
+        self.http = http
+        self.base_url = base_url
+        self.instance = urlsplit(base_url).netloc
+        self.path = path
+        self.emojis: dict[str, str] = {}
+        self.etag: str | None = None
+        self.fetched_at = 0.0
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self.emojis)
+
+    def url(self, name: str) -> str | None:
+        """名前から画像のURLを返す(一覧に無い場合はNone)"""
+        return self.emojis.get(name)
+
+    def resolve(self, notification: Notification) -> tuple[str, str] | None:
+        """
+        リアクションの通知に使う絵文字の画像を探す
+        ローカルの絵文字は一覧から、リモートの絵文字は通知に含まれていたURLを使う
+
+        Args:
+            notification (Notification): 通知
+
+        Returns:
+            tuple[str, str] | None: (画像のURL, キャッシュに保存する時の名前), 見つからない場合はNone
+        """
+        parsed = parse_reaction(notification.reaction)
+        if parsed is None:
+            return None
+        name, host = parsed
+        url = self.url(name) if host is None else notification.reaction_url
+        if url is None:
+            return None
+        return url, image_name(self.instance, name, host)
+
+    def _load(self) -> None:
+        try:
+            with open(file=self.path, mode="r", encoding="UTF-8") as f:
+                saved = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        self.emojis = saved.get("emojis", {})
+        self.etag = saved.get("etag")
+        self.fetched_at = saved.get("fetched_at", 0)
+        log_emoji.info(f"{len(self.emojis)} emojis loaded from {self.path}")
+
+    def _save(self) -> None:
+        tmp_path = f"{self.path}.tmp"
+        with open(file=tmp_path, mode="w", encoding="UTF-8") as f:
+            json.dump({"etag": self.etag, "fetched_at": self.fetched_at, "emojis": self.emojis}, f)
+        os.replace(tmp_path, self.path)
+
+    async def refresh(self) -> bool:
+        """
+        一覧を取得し直す
+
+        Returns:
+            bool: 一覧が変わった場合はTrue
+        """
+        headers = {"If-None-Match": self.etag} if self.etag else None
+        try:
+            async with self.http.get(f"{self.base_url}/api/emojis", headers=headers) as resp:
+                status = resp.status
+                etag = resp.headers.get("ETag")
+                content = await resp.read() if status == 200 else b""
+            if status == 304:
+                self.fetched_at = time.time()
+                log_emoji.debug("emojis not modified")
+                return False
+            if status == 200:
+                data = loads(content)
+            else:
+                # GETに対応していないサーバーではPOSTで取得する
+                etag = None
+                data = await self.http.api(self.base_url, "emojis")
+        except (aiohttp.ClientError, ApiError, TimeoutError, ValueError):
+            log_emoji.warning("emoji list could not be fetched")
+            return False
+
+        emojis = {
+            emoji["name"]: emoji["url"]
+            for emoji in (data.get("emojis", ()) if isinstance(data, dict) else ())
+            if emoji.get("name") and emoji.get("url")
+        }
+        changed = emojis != self.emojis
+        added = len(emojis.keys() - self.emojis.keys())
+        self.emojis = emojis
+        self.etag = etag
+        self.fetched_at = time.time()
+        await asyncio.to_thread(self._save)
+        log_emoji.info(f"{len(emojis)} emojis ({added} new)")
+        return changed
+
+    async def run(self, interval: float) -> None:
+        """
+        一定の間隔で一覧を取得し直す(前回の取得から時間が経っていなければ待ってから取得する)
+
+        Args:
+            interval (float): 取得し直す間隔(秒)
+        """
+        while True:
+            wait = self.fetched_at + interval - time.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            await self.refresh()
+            if time.time() - self.fetched_at >= interval:  # 失敗した場合は少し待ってやり直す
+                await asyncio.sleep(min(interval, 300))
@@ -0,0 +1,354 @@
+import logging
+import re
+from importlib.metadata import entry_points
+
+from aggregator import Group
+from notification import User
+from pipeline import Event
+from text_render import render
+
+log_main = logging.getLogger("main")
+
+# 外部のパッケージからフォーマッタを追加するためのエントリーポイント
+PLUGIN_GROUP = "misskey_notify_client.formatters"
+
+_REMOTE_EMOJI = re.compile(r".+@")
+
+
+class Formatted:
+    """フォーマッタが組み立てた通知の内容(画像はまだ取得していない)"""
+
+    __slots__ = ("title", "content", "image", "image_name")
+
+    def __init__(
+        self,
+        title: str,
+        content: str,
+        image: str | User | None = None,
+        image_name: str | None = None,
+    ) -> None:
+        """
+        Args:
+            title (str): 通知のタイトル
+            content (str): 通知の内容
+            image (str | User | None, optional): ユーザーまたは画像のURL
+            image_name (str | None, optional): 画像がURLの場合の保存時の名前
+        """
+        self.title = title
+        self.content = content
+        self.image = image
+        self.image_name = image_name
+
+
+def display_name(user: User | None) -> str:
+    """ユーザーの表示名(無ければユーザー名)を返す"""
+    if user is None:
+        return ""
+    return user.name or user.username
+
+
+def reaction_label(reaction: str) -> str:
+    """
+    リアクションを表示用の文字列にする
+    カスタム絵文字(:name@host:)の場合は名前だけを取り出す
+    """
+    emoji = _REMOTE_EMOJI.match(reaction)
+    if emoji is not None:
+        return emoji.group()[1:-1]
+    return reaction
+
+
+def group_names(group: Group) -> str:
+    """まとめられた通知のユーザー名を「A、Bと他n人」の形にする"""
+    names = []
+    for body in reversed(group.bodies):  # 新しい順
+        name = display_name(body.user)
+        if name and name not in names:
+            names.append(name)
+    others = group.count - len(names)
+    if others > 0:
+        return f"{'、'.join(names)}と他{others}人"
+    return "、".join(names)
+
+
+class Formatter:
+    """
+    通知の種類ごとのフォーマッタの基底クラス
+
+    サブクラスはtypeに通知の種類を設定し、formatを実装する
+    フォーマッタは起動時に1度だけ作られ、全ての通知で使い回される
+    """
+
+    type: str = ""
+
+    def __init__(self, settings: dict) -> None:
+        """
+        Args:
+            settings (dict): config.jsonの設定
+        """
+        self.body_length = settings.get("max_body_length", 200)
+
+    def text(self, text: str | None, strip_mentions: bool = False) -> str:
+        """ノートのテキストを通知用のプレーンテキストにする"""
+        return render(text, self.body_length, strip_mentions=strip_mentions)
+
+    def format(self, event: Event) -> Formatted | None:
+        """
+        通知の内容を組み立てる
+
+        Args:
+            event (Event): 通知のEvent
+
+        Returns:
+            Formatted | None: 通知の内容(通知しない場合はNone)
+        """
+        raise NotImplementedError
+
+
+class ReactionFormatter(Formatter):
+    type = "reaction"
+
+    def __init__(self, settings: dict) -> None:
+        super().__init__(settings)
+        # emojiの場合はカスタム絵文字のリアクションのアイコンに絵文字の画像を使う(userの場合はユーザーのアイコン)
+        self.emoji_icon = settings.get("reaction_icon", "emoji") == "emoji"
+
+    def format(self, event: Event) -> Formatted | None:
+        body = event.body
+        if event.group is not None:
+            emoji = ", ".join(reaction_label(r) for r in event.group.reactions)
+            title = f"{group_names(event.group)}が{emoji}でリアクションしました"
+        else:
+            title = f"{display_name(body.user)}が{reaction_label(body.reaction or '')}でリアクションしました"
+        if self.emoji_icon and event.account is not None:
+            emoji = event.account.emojis.resolve(body)
+            if emoji is not None:
+                return Formatted(title, self.text(body.note.text), *emoji)
+        return Formatted(title, self.text(body.note.text), body.user)
+
+
+class ReplyFormatter(Formatter):
+    type = "reply"
+
+    def format(self, event: Event) -> Formatted | None:
+        body = event.body
+        msg = self.text(body.note.text, strip_mentions=True)
+        reply = self.text(body.note.reply.text if body.note.reply is not None else None)
+        return Formatted(f"{display_name(body.user)}が返信しました", f"{msg}\n------------\n{reply}", body.user)
+
+
+class MentionFormatter(Formatter):
+    type = "mention"
+
+    def format(self, event: Event) -> Formatted | None:
+        body = event.body
+        return Formatted(
+            f"{display_name(body.user)}がメンションしました",
+            self.text(body.note.text, strip_mentions=True),
+            body.user,
+        )
+
+
+class RenoteFormatter(Formatter):
+    type = "renote"
+
+    def format(self, event: Event) -> Formatted | None:
+        body = event.body
+        if event.group is not None:
+            title = f"{group_names(event.group)}がリノートしました"
+        else:
+            title = f"{display_name(body.user)}がリノートしました"
+        return Formatted(title, self.text(body.note.renote.text), body.user)
+
+
+class QuoteFormatter(Formatter):
+    type = "quote"
+
+    def format(self, event: Event) -> Formatted | None:
+        body = event.body
+        return Formatted(
+            f"{display_name(body.user)}が引用リノートしました",
+            f"{self.text(body.note.text)}\n-------------\n{self.text(body.note.renote.text)}",
+            body.user,
+        )
+
+
+class FollowFormatter(Formatter):
+    type = "follow"
+    message = "ホョローされました"
+
+    def format(self, event: Event) -> Formatted | None:
+        user = event.body.user
+        return Formatted(f"{display_name(user)}@{user.host}", self.message, user)
+
+
+class FollowRequestAcceptedFormatter(FollowFormatter):
+    type = "followRequestAccepted"
+    message = "ホョローが承認されました"
+
+
+class ReceiveFollowRequestFormatter(FollowFormatter):
+    type = "receiveFollowRequest"
+    message = "ホョローがリクエストされました"
+
+
+class PollEndedFormatter(Formatter):
+    type = "pollEnded"
+
+    def format(self, event: Event) -> Formatted | None:
+        body = event.body
+        votes = 0
+        most_vote = None
+        voted = None
+        note = body.note
+        me = event.account.me if event.account is not None else None
+        if me is not None and note.user is not None and note.user.id == me["id"]:
+            title = "自身が開始したアンケートの結果が出ました"
+        else:
+            title = f"{display_name(note.user)}のアンケートの結果が出ました"
+        message = f"{self.text(note.text)}\n------------"
+        for choice in note.poll or ():
+            if choice.is_voted:
+                voted = choice
+            else:
+                if choice.votes > votes:
+                    most_vote = choice
+                    votes = choice.votes
+        if most_vote is None:
+            if voted is not None:
+                message += f"\n✅🏆:{voted.text}|{voted.votes}票"
+        else:
+            if voted is not None:
+                message += f"\n✅  :{voted.text}|{voted.votes}票"
+            message += f"\n  🏆:{most_vote.text}|{most_vote.votes}票"
+        return Formatted(title, message, body.user or note.user)
+
+
+class AppFormatter(Formatter):
+    type = "app"
+
+    def format(self, event: Event) -> Formatted | None:
+        body = event.body
+        return Formatted(body.header or "", self.text(body.body), body.icon, body.header)
+
+
+class NoteFormatter(Formatter):
+    type = "note"
+
+    def format(self, event: Event) -> Formatted | None:
+        body = event.body
+        title = f"{display_name(body.user)}がノートしました"
+        if body.header:  # アンテナ/リストなどのチャンネルから届いたノート
+            title = f"[{body.header}] {title}"
+        return Formatted(title, self.text(body.note.text), body.user)
+
+
+class AchievementEarnedFormatter(Formatter):
+    type = "achievementEarned"
+
+    def format(self, event: Event) -> Formatted | None:
+        return Formatted("実績を獲得しました", event.body.achievement or "")
+
+
+class RoleAssignedFormatter(Formatter):
+    type = "roleAssigned"
+
+    def format(self, event: Event) -> Formatted | None:
+        role = event.body.role
+        if role is None:
+            return Formatted("ロールが付与されました", "")
+        return Formatted("ロールが付与されました", role.name, role.icon_url, role.id)
+
+
+class GenericFormatter(Formatter):
+    """登録されていない種類の通知や、フォーマッタが失敗した場合に使うフォーマッタ"""
+
+    type = "*"
+
+    def format(self, event: Event) -> Formatted | None:
+        body = event.body
+        user = body.user
+        title = f"{display_name(user)}からの通知({body.type})" if user else f"通知({body.type})"
+        note_text = body.note.text if body.note is not None else None
+        content = self.text(note_text or body.body or body.header)
+        return Formatted(title, content, user)
+
+
+BUILTIN_FORMATTERS: tuple[type[Formatter], ...] = (
+    ReactionFormatter,
+    ReplyFormatter,
+    MentionFormatter,
+    RenoteFormatter,
+    QuoteFormatter,
+    FollowFormatter,
+    FollowRequestAcceptedFormatter,
+    ReceiveFollowRequestFormatter,
+    PollEndedFormatter,
+    AppFormatter,
+    NoteFormatter,
+    AchievementEarnedFormatter,
+    RoleAssignedFormatter,
+)
+
+
+class FormatterRegistry:
+    """
+    通知の種類: フォーマッタ の表
+
+    config.jsonのnotify_typesでfalseにした種類は画像の取得や文字列の組み立ての前に捨てる
+    """
+
+    def __init__(self, settings: dict) -> None:
+        """
+        Args:
+            settings (dict): config.jsonの設定
+        """
+        self.settings = settings
+        self.disabled = {
+            notify_type
+            for notify_type, enabled in settings.get("notify_types", {}).items()
+            if not enabled
+        }
+        self.formatters: dict[str, Formatter] = {}
+        self.fallback = GenericFormatter(settings)
+        for formatter_class in BUILTIN_FORMATTERS:
+            self.register(formatter_class(settings))
+
+    def register(self, formatter: Formatter) -> None:
+        """フォーマッタを登録する(同じ種類の物があれば置き換える)"""
+        self.formatters[formatter.type] = formatter
+
+    def load_plugins(self) -> None:
+        """エントリーポイントからフォーマッタ(Formatterのサブクラス)を読み込んで登録する"""
+        for entry_point in entry_points(group=PLUGIN_GROUP):
+            try:
+                self.register(entry_point.load()(self.settings))
+                log_main.info(f"Formatter plugin loaded: {entry_point.name}")
+            except Exception:
+                log_main.exception(f"Formatter plugin could not be loaded: {entry_point.name}")
+
+    def is_enabled(self, event: Event) -> bool:
+        """通知する種類かどうかを返す"""
+        return event.body.type not in self.disabled
+
+    def format(self, event: Event) -> Formatted | None:
+        """
+        通知の種類に合ったフォーマッタで通知の内容を組み立てる
+        フォーマッタが例外を出した場合はその通知だけ汎用のフォーマッタで組み立て直す
+
+        Args:
+            event (Event): 通知のEvent
+
+        Returns:
+            Formatted | None: 通知の内容(通知しない場合はNone)
+        """
+        notify_type = event.body.type
+        formatter = self.formatters.get(notify_type, self.fallback)
+        log_main.debug(f"Type: {notify_type}")
+        try:
+            return formatter.format(event)
+        except Exception:
+            log_main.exception(f"formatter for '{notify_type}' failed")
+            if formatter is self.fallback:
+                return None
+            return self.fallback.format(event)
@@ -0,0 +1,152 @@
+import asyncio
+import logging
+from types import SimpleNamespace
+from typing import Any
+
+import aiohttp
+
+import metrics
+
+log_http = logging.getLogger("http")
+
+
+class ApiError(Exception):
+    """APIがエラーのステータスコードを返した場合の例外"""
+
+    def __init__(self, endpoint: str, status: int) -> None:
+        """
+        Args:
+            endpoint (str): 呼び出したエンドポイント
+            status (int): ステータスコード
+        """
+        super().__init__(f"{endpoint}: {status}")
+        self.endpoint = endpoint
+        self.status = status
+
+
+class HttpClient:
+    """
+    全てのREST APIの呼び出しと画像のダウンロードで共有する非同期のHTTPクライアント
+
+    ホストごとにコネクションを使い回し(keep-alive)、同時接続数は全体とホストごとに上限を設ける
+    名前解決の結果は短い間キャッシュする
+    新しく接続した(TCP/TLSのハンドシェイクをした)回数と使い回した回数はmetricsに記録する
+    """
+
+    def __init__(
+        self,
+        timeout: float = 10,
+        limit: int = 32,
+        limit_per_host: int = 8,
+        dns_ttl: float = 300,
+        keepalive_timeout: float = 60,
+    ) -> None:
+        """
+        Args:
+            timeout (float, optional): 1リクエストのタイムアウト(秒)
+            limit (int, optional): 全体の同時接続数の上限
+            limit_per_host (int, optional): ホストごとの同時接続数の上限
+            dns_ttl (float, optional): 名前解決の結果をキャッシュする時間(秒)
+            keepalive_timeout (float, optional): 使っていない接続を残しておく時間(秒)
+        """
+        self.timeout = timeout
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_ttl = dns_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self._session: aiohttp.ClientSession | None = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """セッション(イベントループの中で初めて使う時に作る)"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=self.dns_ttl,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                trace_configs=[self._trace_config()],
+            )
+        return self._session
+
+    @staticmethod
+    def _trace_config() -> aiohttp.TraceConfig:
+        async def on_request_start(session: Any, ctx: SimpleNamespace, params: Any) -> None:
+            ctx.host = params.url.host
+
+        async def on_connection_create_end(session: Any, ctx: SimpleNamespace, params: Any) -> None:
+            metrics.HANDSHAKES.inc(host=getattr(ctx, "host", ""))
+
+        async def on_connection_reuseconn(session: Any, ctx: SimpleNamespace, params: Any) -> None:
+            metrics.CONNECTIONS_REUSED.inc()
+
+        async def on_dns_cache_miss(session: Any, ctx: SimpleNamespace, params: Any) -> None:
+            metrics.DNS_LOOKUPS.inc()
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        trace_config.on_dns_cache_miss.append(on_dns_cache_miss)
+        return trace_config
+
+    def get(self, url: str, headers: dict | None = None) -> Any:
+        """
+        GETリクエスト(async withで使う)
+
+        Args:
+            url (str): URL
+            headers (dict | None, optional): 追加のヘッダー
+        """
+        return self.session.get(url, headers=headers)
+
+    async def status(self, url: str) -> int:
+        """
+        GETしてステータスコードだけを返す(本文は読み捨てる)
+
+        Raises:
+            aiohttp.ClientError: 接続できなかった場合
+            TimeoutError: タイムアウトした場合
+        """
+        async with self.session.get(url) as resp:
+            await resp.read()
+            return resp.status
+
+    async def api(self, base_url: str, endpoint: str, token: str | None = None, **params: Any) -> Any:
+        """
+        MisskeyのAPIを呼び出す(値がNoneの引数は送らない)
+
+        Args:
+            base_url (str): インスタンスのURL(https://example.com)
+            endpoint (str): エンドポイント(i/notificationsなど)
+            token (str | None, optional): APIトークン
+
+        Returns:
+            Any: 結果のJSON(204の場合はNone)
+
+        Raises:
+            ApiError: エラーのステータスコードが返された場合
+            aiohttp.ContentTypeError: JSONが返されなかった場合
+            aiohttp.ClientError: 接続できなかった場合
+            TimeoutError: タイムアウトした場合
+        """
+        body = {key: value for key, value in params.items() if value is not None}
+        if token is not None:
+            body["i"] = token
+        async with self.session.post(f"{base_url}/api/{endpoint}", json=body) as resp:
+            if resp.status >= 400:
+                await resp.read()
+                raise ApiError(endpoint, resp.status)
+            if resp.status == 204:
+                return None
+            return await resp.json()
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            # SSLの接続が閉じきるのを少し待つ(aiohttpの推奨)
+            await asyncio.sleep(0.25)
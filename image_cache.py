@@ -0,0 +1,188 @@
+import asyncio
+import logging
+import os
+import time
+from hashlib import sha256
+
+import aiohttp
+import metrics
+from http_client import HttpClient
+from image_process import ImageProcessor, sniff_format
+from image_store import ImageStore
+
+log_img = logging.getLogger("img_get")
+
+
+class ImageCache:
+    """
+    通知に使う画像(ユーザーのアイコン/アプリのアイコン)の非同期キャッシュ
+
+    キャッシュにヒットした場合はネットワークにもディスクにも触らず即座にパスを返し
+    TTLを過ぎたものはバックグラウンドでETag/Last-Modifiedを使って再検証する
+    同じURLへの同時リクエストは1つにまとめられる
+    """
+
+    def __init__(
+        self,
+        store: ImageStore,
+        http: HttpClient | None = None,
+        processor: ImageProcessor | None = None,
+        ttl: float = 3600,
+        fallback: str = "icon/icon.png",
+    ) -> None:
+        """
+        Args:
+            store (ImageStore): 画像のインデックスを保持するストア
+            http (HttpClient | None, optional): 共有するHTTPクライアント
+            processor (ImageProcessor | None, optional): ダウンロードした画像をアイコン用に変換するもの
+            ttl (float, optional): 再検証せずにキャッシュをそのまま使う時間(秒)
+            fallback (str, optional): 画像が取得できなかった場合に返すパス
+        """
+        self.store = store
+        self.data_dir = store.data_dir
+        self.ttl = ttl
+        self.fallback = fallback
+        self._inflight: dict[tuple[str, str], asyncio.Task] = {}
+        self._background: set[asyncio.Task] = set()
+        self.http = http or HttpClient()
+        self.processor = processor or ImageProcessor()
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, url: str | None, name: str) -> str:
+        """
+        画像のパスを返す
+
+        Args:
+            url (str | None): 画像のURL
+            name (str): 保存時の名前(ユーザーIDまたはアプリ名)
+
+        Returns:
+            image_path str: 画像のパス
+        """
+        if not url:
+            return self.fallback
+
+        started = time.perf_counter()
+        entry = self.store.get(name)
+        if entry is not None:
+            if entry.get("url") is None:
+                # 旧形式から移行したものはURLが分からないので一度だけ再検証させる
+                self.store.touch(name, url=url, fetched_at=0)
+            if entry["url"] == url:
+                if (
+                    time.time() - entry.get("fetched_at", 0) > self.ttl
+                    or entry.get("format") != self.processor.tag
+                ):
+                    # アイコン用に変換されていないもの(以前の形式や大きさ)はすぐに取得し直す
+                    self._revalidate(url, name)
+                log_img.debug("cache hit")
+                self.hits += 1
+                metrics.IMAGE_GET.observe(time.perf_counter() - started, result="hit")
+                return entry["path"]
+
+        log_img.debug("cache miss")
+        self.misses += 1
+        path = await self._fetch(url, name)
+        metrics.IMAGE_GET.observe(time.perf_counter() - started, result="miss")
+        return path
+
+    def prefetch(self, url: str, name: str) -> None:
+        """
+        キャッシュに無ければバックグラウンドで取得を始める
+        後からgetされた場合は取得中のものを待つだけになる
+        """
+        entry = self.store.entries.get(name)
+        if entry is not None and entry.get("url") == url:
+            return
+        log_img.debug(f"prefetch {name}")
+        self._revalidate(url, name)
+
+    def _revalidate(self, url: str, name: str) -> None:
+        """バックグラウンドで再検証を行う"""
+        if (name, url) in self._inflight:
+            return
+        task = asyncio.create_task(self._fetch(url, name))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _fetch(self, url: str, name: str) -> str:
+        """同じURLへの同時リクエストをまとめてダウンロードする"""
+        key = (name, url)
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._download(url, name))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _download(self, url: str, name: str) -> str:
+        """
+        画像をダウンロードして保存する
+        キャッシュが存在する場合は条件付きリクエストで変更があった時だけ取得する
+        """
+        entry = self.store.entries.get(name)
+        # 今の設定でアイコン用に変換したものでなければ、条件付きリクエストも同じハッシュの省略もしない
+        converted = entry is not None and entry.get("format") == self.processor.tag
+        headers = {}
+        if converted and entry.get("url") == url:  # type: ignore[union-attr]
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        try:
+            async with self.http.get(url, headers=headers) as resp:
+                status = resp.status
+                resp_headers = resp.headers
+                content = await resp.read()
+        except (aiohttp.ClientError, TimeoutError):
+            log_img.warning("request failed")
+            return entry["path"] if entry is not None else self.fallback
+
+        if status == 304 and converted:
+            log_img.info("Not modified")
+            self.store.touch(name, fetched_at=time.time())
+            return entry["path"]
+
+        if status != 200:
+            log_img.info("StatusCode error: No image downloaded")
+            return entry["path"] if entry is not None else self.fallback
+
+        digest = sha256(content).hexdigest()
+        if converted and entry.get("hash") == digest:  # type: ignore[union-attr]
+            img_path = entry["path"]
+            log_img.info("Same hash: image not saved")
+        else:
+            image_format = sniff_format(content)
+            if image_format is None:
+                log_img.warning("Not an image: image not saved")
+                return entry["path"] if entry is not None else self.fallback
+            log_img.debug(f"Image format: {image_format}")
+            img_path = os.path.join(self.data_dir, f"{name}.png")
+            try:
+                await self.processor.save_icon(content, img_path)
+            except OSError:
+                log_img.warning("Image could not be decoded/saved")
+                return entry["path"] if entry is not None else self.fallback
+            log_img.info("Image saved")
+            if entry is not None and entry["path"] != img_path:
+                # 拡張子が変わった場合は古い画像を消しておく
+                try:
+                    os.remove(entry["path"])
+                except OSError:
+                    pass
+
+        self.store.put(
+            name,
+            {
+                "path": img_path,
+                "hash": digest,
+                "url": url,
+                "etag": resp_headers.get("ETag"),
+                "last_modified": resp_headers.get("Last-Modified"),
+                "fetched_at": time.time(),
+                "format": self.processor.tag,
+            },
+        )
+        return img_path
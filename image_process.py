@@ -0,0 +1,116 @@
+"""
+通知のアイコン用に画像を小さな静止画のPNGにするモジュール
+
+通知に表示されるのは小さなアイコンだけなので、アニメーション画像は最初のフレームだけを使い
+アイコンの大きさまで縮小してから保存する(ディスクの使用量もデコードの手間も減る)
+Pillowは実際に変換する時まで読み込まない(画像を使わないヘッドレスでの起動を軽くするため)
+"""
+
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+# ファイルの先頭のバイト列: 形式
+_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+    (b"BM", "bmp"),
+    (b"\x00\x00\x01\x00", "ico"),
+    (b"II*\x00", "tiff"),
+    (b"MM\x00*", "tiff"),
+)
+
+
+def sniff_format(data: bytes) -> str | None:
+    """
+    先頭のバイト列だけを見て画像の形式を判定する(デコードはしない)
+
+    Args:
+        data (bytes): 画像のデータ
+
+    Returns:
+        str | None: 形式(png/jpeg/gif/webp/avif/...), 画像でない場合はNone
+    """
+    for signature, image_format in _SIGNATURES:
+        if data.startswith(signature):
+            return image_format
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    if data[4:8] == b"ftyp" and data[8:12] in (b"avif", b"avis"):
+        return "avif"
+    return None
+
+
+def make_icon(data: bytes, size: int) -> bytes:
+    """
+    画像を通知のアイコン用のPNGにする(最初のフレームだけを使い、size x size に収まるよう縮小する)
+
+    Args:
+        data (bytes): 元の画像のデータ
+        size (int): アイコンの最大の幅/高さ(px)
+
+    Returns:
+        bytes: PNGのデータ
+
+    Raises:
+        OSError: デコードできなかった場合
+    """
+    from PIL import Image
+
+    try:
+        with Image.open(BytesIO(data)) as img:
+            # JPEGは縮小した大きさで直接デコードさせる(全体をデコードしてから縮小するより速い)
+            img.draft("RGB", (size, size))
+            img.seek(0)  # アニメーション画像は最初のフレームだけ
+            icon = img.convert("RGBA")
+    except Image.DecompressionBombError as e:
+        raise OSError(e) from e
+    icon.thumbnail((size, size), Image.Resampling.LANCZOS)
+    with BytesIO() as buf:
+        icon.save(buf, format="PNG")
+        return buf.getvalue()
+
+
+def save_icon(data: bytes, path: str, size: int) -> None:
+    """make_iconしてpathに書き込む(途中で失敗しても壊れたファイルが残らないよう一時ファイルから置き換える)"""
+    icon = make_icon(data, size)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, mode="wb") as f:
+        f.write(icon)
+    os.replace(tmp_path, path)
+
+
+class ImageProcessor:
+    """
+    画像の変換をイベントループの外(スレッドプール)で行う
+
+    PillowはデコードやリサイズのあいだGILを解放するので、複数の画像を並行して変換できる
+    """
+
+    def __init__(self, size: int = 128, workers: int = 2) -> None:
+        """
+        Args:
+            size (int, optional): アイコンの最大の幅/高さ(px)
+            workers (int, optional): 変換を行うスレッドの数
+        """
+        self.size = size
+        # 変換の種類(変換の方法やアイコンの大きさが変わった画像は保存し直す)
+        self.tag = f"icon-v1-{size}"
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image")
+
+    async def save_icon(self, data: bytes, path: str) -> None:
+        """
+        画像をアイコン用のPNGにしてpathに保存する
+
+        Raises:
+            OSError: デコード/保存できなかった場合
+        """
+        await asyncio.get_running_loop().run_in_executor(
+            self._executor, save_icon, data, path, self.size
+        )
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,262 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from glob import glob
+from hashlib import sha256
+
+log_img = logging.getLogger("img_get")
+
+COLUMNS = (
+    "name",
+    "path",
+    "hash",
+    "size",
+    "url",
+    "etag",
+    "last_modified",
+    "fetched_at",
+    "last_access",
+    "format",  # 保存した画像の変換の種類(ImageProcessor.tag, 元の形式のまま保存したものはNone)
+)
+
+
+class ImageStore:
+    """
+    画像キャッシュのインデックスを保持するSQLiteのストア
+
+    インデックスは起動時に全件メモリへ読み込み(LRU順)、書き込みはまとめて1トランザクションで行う
+    容量/件数の上限を超えた場合は最後に使われた時刻が古いものから削除する
+    """
+
+    def __init__(
+        self,
+        data_dir: str = ".data",
+        max_bytes: int = 100 * 1024 * 1024,
+        max_entries: int = 2000,
+        flush_interval: float = 5,
+    ) -> None:
+        """
+        Args:
+            data_dir (str, optional): 画像とデータベースを保存するフォルダ
+            max_bytes (int, optional): 画像の合計サイズの上限(バイト)
+            max_entries (int, optional): 画像の件数の上限
+            flush_interval (float, optional): 変更をまとめて書き込むまでの待ち時間(秒)
+        """
+        self.data_dir = data_dir
+        self.db_path = os.path.join(data_dir, "images.db")
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self.entries: OrderedDict[str, dict] = OrderedDict()
+        self.total_bytes = 0
+        self._dirty: set[str] = set()
+        self._deleted: dict[str, str] = {}  # 名前: 削除するファイルのパス
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+        self._flush_handle: asyncio.TimerHandle | None = None
+        self._writes: set[asyncio.Future] = set()  # スレッドで実行中の書き込み
+
+    def open(self) -> None:
+        """データベースを開いてインデックスをメモリに読み込む"""
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS images ("
+                "name TEXT PRIMARY KEY, path TEXT NOT NULL, hash TEXT, size INTEGER NOT NULL, "
+                "url TEXT, etag TEXT, last_modified TEXT, fetched_at REAL, last_access REAL, format TEXT)"
+            )
+            # formatの列が無い以前のデータベースには列を追加する
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(images)")}
+            if "format" not in columns:
+                self._conn.execute("ALTER TABLE images ADD COLUMN format TEXT")
+        rows = self._conn.execute(
+            f"SELECT {', '.join(COLUMNS)} FROM images ORDER BY last_access"
+        ).fetchall()
+        for row in rows:
+            entry = dict(zip(COLUMNS, row))
+            name = entry.pop("name")
+            if not os.path.exists(entry["path"]):
+                self._deleted[name] = entry["path"]
+                continue
+            self.entries[name] = entry
+            self.total_bytes += entry["size"]
+
+        if len(rows) == 0:
+            self._migrate()
+        self._evict()
+        self.flush()
+        log_img.info(f"Image store opened: {len(self.entries)} entries, {self.total_bytes} bytes")
+
+    def _migrate(self) -> None:
+        """旧形式の.data/hash.jsonと.data内の画像を一度だけ取り込む"""
+        hash_path = os.path.join(self.data_dir, "hash.json")
+        try:
+            with open(file=hash_path, mode="r", encoding="UTF-8") as f:
+                hash_json = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            hash_json = {}
+
+        for path in glob(os.path.join(self.data_dir, "*.*")):
+            name, ext = os.path.splitext(os.path.basename(path))
+            if ext in (".json", ".db", ".tmp", ".bak") or ext.startswith(".db"):
+                continue
+            value = hash_json.get(name)
+            if isinstance(value, dict):  # 非同期キャッシュ導入直後の形式
+                entry = {k: value.get(k) for k in COLUMNS if k != "name"}
+            else:
+                entry = {"hash": value, "url": None, "etag": None, "last_modified": None}
+            if entry["hash"] is None:
+                with open(path, mode="rb") as f:
+                    entry["hash"] = sha256(f.read()).hexdigest()
+            entry["path"] = path
+            entry["size"] = os.path.getsize(path)
+            entry["fetched_at"] = entry.get("fetched_at") or 0
+            entry["last_access"] = os.path.getmtime(path)
+            self.entries[name] = entry
+            self.total_bytes += entry["size"]
+            self._dirty.add(name)
+
+        self.entries = OrderedDict(
+            sorted(self.entries.items(), key=lambda item: item[1]["last_access"])
+        )
+        if os.path.exists(hash_path):
+            os.replace(hash_path, f"{hash_path}.bak")
+        log_img.info(f"Migrated {len(self.entries)} images from hash.json")
+
+    def get(self, name: str) -> dict | None:
+        """
+        エントリを取得して最終アクセス時刻を更新する
+
+        Args:
+            name (str): 画像の名前
+
+        Returns:
+            entry dict | None: エントリ(存在しない場合はNone)
+        """
+        entry = self.entries.get(name)
+        if entry is not None:
+            entry["last_access"] = time.time()
+            self.entries.move_to_end(name)
+            self._mark_dirty(name)
+        return entry
+
+    def put(self, name: str, entry: dict) -> None:
+        """
+        エントリを追加/更新する
+
+        Args:
+            name (str): 画像の名前
+            entry (dict): path, hash, url, etag, last_modified, fetched_at, formatを持つdict
+        """
+        old = self.entries.pop(name, None)
+        if old is not None:
+            self.total_bytes -= old["size"]
+        entry["size"] = os.path.getsize(entry["path"])
+        entry["last_access"] = time.time()
+        self.entries[name] = entry
+        self.total_bytes += entry["size"]
+        self._deleted.pop(name, None)
+        self._mark_dirty(name)
+        self._evict()
+
+    def touch(self, name: str, **fields) -> None:
+        """エントリの一部の項目だけを更新する"""
+        entry = self.entries.get(name)
+        if entry is not None:
+            entry.update(fields)
+            self._mark_dirty(name)
+
+    def _evict(self) -> None:
+        """上限を超えている間、最後に使われた時刻が古いものから削除する"""
+        while len(self.entries) > 1 and (
+            self.total_bytes > self.max_bytes or len(self.entries) > self.max_entries
+        ):
+            name, entry = self.entries.popitem(last=False)
+            self.total_bytes -= entry["size"]
+            self._dirty.discard(name)
+            self._deleted[name] = entry["path"]
+            log_img.debug(f"evict {name}")
+
+    def _mark_dirty(self, name: str) -> None:
+        self._dirty.add(name)
+        if self._flush_handle is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                return
+            self._flush_handle = loop.call_later(self.flush_interval, self._schedule_flush)
+
+    def _schedule_flush(self) -> None:
+        self._flush_handle = None
+        rows, deleted = self._snapshot()
+        future = asyncio.get_running_loop().run_in_executor(None, self._write, rows, deleted)
+        self._writes.add(future)
+        future.add_done_callback(self._write_done)
+
+    def _write_done(self, future: asyncio.Future) -> None:
+        """スレッドでの書き込みが失敗した場合はログに出す(結果を待つ人がいないため)"""
+        self._writes.discard(future)
+        if not future.cancelled() and future.exception() is not None:
+            log_img.error("Image store flush failed", exc_info=future.exception())
+
+    def _snapshot(self) -> tuple[list[tuple], dict[str, str]]:
+        """書き込む内容をイベントループ側で確定させる"""
+        rows = [
+            (name, *(self.entries[name].get(k) for k in COLUMNS[1:]))
+            for name in self._dirty
+            if name in self.entries
+        ]
+        live_paths = {entry["path"] for entry in self.entries.values()}
+        deleted = {name: path for name, path in self._deleted.items() if path not in live_paths}
+        self._dirty = set()
+        self._deleted = {}
+        return rows, deleted
+
+    def _write(self, rows: list[tuple], deleted: dict[str, str]) -> None:
+        """まとめて1トランザクションで書き込む(スレッドで実行される)"""
+        if len(rows) == 0 and len(deleted) == 0:
+            return
+        with self._lock:
+            if self._conn is None:
+                log_img.warning(f"Image store already closed: {len(rows)} updates not written")
+                return
+            with self._conn:
+                self._conn.executemany(
+                    f"INSERT OR REPLACE INTO images ({', '.join(COLUMNS)}) "
+                    f"VALUES ({', '.join('?' * len(COLUMNS))})",
+                    rows,
+                )
+                self._conn.executemany(
+                    "DELETE FROM images WHERE name = ?", [(name,) for name in deleted]
+                )
+        for path in deleted.values():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        log_img.info(f"Image store flushed: {len(rows)} updated, {len(deleted)} deleted")
+
+    def flush(self) -> None:
+        """溜まっている変更をすぐに書き込む"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._write(*self._snapshot())
+
+    async def wait_writes(self) -> None:
+        """スレッドで実行中の書き込みが終わるまで待つ(closeの前に呼び出す)"""
+        if self._writes:
+            await asyncio.gather(*self._writes, return_exceptions=True)
+
+    def close(self) -> None:
+        """変更を書き込んでデータベースを閉じる"""
+        self.flush()
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
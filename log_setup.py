@@ -0,0 +1,102 @@
+"""
+ログの設定
+
+ログの書き込みはQueueHandlerで別スレッド(QueueListener)に渡すので、イベントループがディスクの書き込みを待つことは無い
+latest.logは起動するたびに前回の分をlatest.log.1, .2, ...にずらして残し、サイズが上限を超えた場合もずらす
+"""
+
+import logging
+import os
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+LOG_FORMAT = "%(asctime)s %(name)s - %(levelname)s: %(message)s"  # 出力のフォーマット
+DATE_FORMAT = "[%Y-%m-%dT%H:%M:%S%z]"  # 時間(asctime)のフォーマット
+
+LOG_LEVELS = {
+    "DEBUG": logging.DEBUG,
+    "INFO": logging.INFO,
+    "WARNING": logging.WARNING,
+    "ERROR": logging.ERROR,
+    "CRITICAL": logging.CRITICAL,
+}
+
+
+def setup_logging(
+    level: int = logging.WARNING,
+    path: str = "./latest.log",
+    max_bytes: int = 10 * 1024 * 1024,
+    backup_count: int = 5,
+) -> QueueListener:
+    """
+    ルートロガーにQueueHandlerを付け、ファイルへの書き込みはバックグラウンドのスレッドで行う
+
+    Args:
+        level (int, optional): ログのレベル
+        path (str, optional): ログファイルのパス
+        max_bytes (int, optional): 1ファイルの上限(バイト, 0で無制限)
+        backup_count (int, optional): 残す古いログファイルの数(前回以前の起動の分を含む)
+
+    Returns:
+        QueueListener: 終了時にstop()を呼び出して残りのログを書き込むこと
+    """
+    file_handler = RotatingFileHandler(
+        path, maxBytes=max_bytes, backupCount=backup_count, encoding="UTF-8", delay=True
+    )
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT, DATE_FORMAT))
+    # 前回の起動のログを消さずにずらして残す
+    if backup_count > 0 and os.path.exists(path) and os.path.getsize(path) > 0:
+        file_handler.doRollover()
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(log_queue))
+    root.setLevel(level)
+
+    listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+class PayloadCapture:
+    """
+    DEBUGレベルの時に受信したペイロードをログに残すかどうかと、残す内容を決める
+
+    全件をそのまま書くと重いので、sample_rateの割合だけ、先頭max_bytes文字までを残す
+    """
+
+    def __init__(self, sample_rate: float = 0.1, max_bytes: int = 1024) -> None:
+        """
+        Args:
+            sample_rate (float, optional): ログに残す割合(0〜1)
+            max_bytes (int, optional): 残す最大の長さ(0で制限なし)
+        """
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+
+    def capture(self, logger: logging.Logger, frame: str | bytes) -> str | None:
+        """
+        ログに残す場合は切り詰めたペイロードを返す
+
+        Args:
+            logger (logging.Logger): 書き込むロガー(DEBUGが無効なら何もしない)
+            frame (str | bytes): 受信したフレーム
+
+        Returns:
+            str | None: 残さない場合はNone
+        """
+        if not logger.isEnabledFor(logging.DEBUG):
+            return None
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return None
+        size = len(frame)
+        suffix = ""
+        if self.max_bytes and size > self.max_bytes:
+            frame = frame[: self.max_bytes]
+            suffix = f"... ({size} total)"
+        if isinstance(frame, bytes):
+            frame = frame.decode("UTF-8", errors="replace")
+        return frame + suffix
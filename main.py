@@ -1,497 +1,263 @@
+import argparse
 import asyncio
+import contextlib
 import json
-from math import log
 import os
-import re
-from glob import glob
-from hashlib import sha256
-from io import BytesIO
-from sys import exit
+import signal
+import sys
+import time
 import logging
 
-import pystray
-import requests
-import websockets
-from misskey import Misskey
-from misskey import exceptions as mk_exceptions
-from notifypy import Notify
-from PIL import Image
+# asyncio.timeout, Task.cancelling, asyncio.TimeoutErrorとTimeoutErrorの統合などを使っているため
+# (古いPythonではこの後のモジュールの読み込み自体が構文エラーになるので、読み込む前に確かめる)
+if sys.version_info < (3, 11):
+    sys.exit("Python 3.11以上が必要です")
 
-notifier = Notify()
+from account import Account  # noqa: E402
+from client import Client  # noqa: E402
+from commands import CommandBridge  # noqa: E402
+from log_setup import LOG_LEVELS, setup_logging  # noqa: E402
+
+startup_started = time.perf_counter()
 
 app_name = "Misskey-Notify-Client"
 app_icon = "icon/icon.png"
 
-# ignore_events = ['unreadNotification', 'readAllNotifications', 'unreadMention', 'readAllUnreadMentions', 'unreadSpecifiedNote', 'readAllUnreadSpecifiedNotes', 'unreadMessagingMessage', 'readAllMessagingMessages']
+parser = argparse.ArgumentParser(description=app_name)
+parser.add_argument(
+    "--headless",
+    action="store_true",
+    help="トレイアイコンとOSの通知を使わずに起動する(通知はconfig.jsonのsinksに送る, 既定は標準出力)",
+)
+args = parser.parse_args()
 
+# ignore_events = ['unreadNotification', 'readAllNotifications', 'unreadMention', 'readAllUnreadMentions', 'unreadSpecifiedNote', 'readAllUnreadSpecifiedNotes', 'unreadMessagingMessage', 'readAllMessagingMessages']
 
-ws_reconnect_count = 0
 
 # ./config.jsonが存在するかどうかの確認
 if os.path.exists("config.json"):
+    # 存在する場合openして中身を変数に格納
     config = json.load(open(file="config.json", mode="r", encoding="UTF-8"))
-    # 存在する場合openして中身を変数に格納しつつログの設定
-    match config["log_level"]:
-        case "DEBUG":
-            log_level = logging.DEBUG
-        case "INFO":
-            log_level = logging.INFO
-        case "WARNING":
-            log_level = logging.WARNING
-        case "ERROR":
-            log_level = logging.ERROR
-        case "CRITICAL":
-            log_level = logging.CRITICAL
-        case _:
-            log_level = logging.WARNING
-    logging.basicConfig(
-        format="%(asctime)s %(name)s - %(levelname)s: %(message)s",  # 出力のフォーマット
-        datefmt="[%Y-%m-%dT%H:%M:%S%z]",  # 時間(asctime)のフォーマット
-        filename="./latest.log",
-        filemode="w",
-        encoding="UTF-8",
-        level=log_level,
-    )
-    log_main = logging.getLogger("main")
-    log_img = logging.getLogger("img_get")
-    log_notify = logging.getLogger("notifier")
-    log_main.info("Config loaded")
+    config_message = "Config loaded"
 else:
-    # config.json作成とともにログの設定
     config = {}  # 存在しない場合インスタンスドメイン+トークンを聞きconfig.jsonを新規作成&保存
-    config["host"] = input("ドメインを入力してください(例:example.com)-> https:// ")
-    config["i"] = input('"通知を見る"の権限を有効にしたAPIトークンを入力してください->')
+    config["accounts"] = [
+        {
+            "host": input("ドメインを入力してください(例:example.com)-> https:// "),
+            "i": input('"通知を見る"の権限を有効にしたAPIトークンを入力してください->'),
+        }
+    ]
     config["request_timeout"] = 10
+    # APIと画像のダウンロードの同時接続数の上限(全体/ホストごと)と名前解決のキャッシュの時間(秒)
+    config["http_max_connections"] = 32
+    config["http_max_connections_per_host"] = 8
+    config["dns_cache_ttl"] = 300
     config["ws_reconnect_limit"] = 10
+    config["ws_reconnect_max_delay"] = 60
+    # 接続の生存確認(ping)の間隔と、応答が無ければ切断して再接続するまでの時間(秒, 間隔を0にすると無効)
+    config["ws_ping_interval"] = 15
+    config["ws_ping_timeout"] = 5
+    config["catch_up_max_pages"] = 5
+    config["image_cache_ttl"] = 3600
+    config["image_cache_max_mb"] = 100
+    config["image_cache_max_entries"] = 2000
+    # 通知のアイコンの大きさ(px)と画像の変換を行うスレッドの数
+    config["icon_size"] = 128
+    config["image_workers"] = 2
+    config["queue_size"] = 100
+    config["queue_overflow"] = "drop_oldest"
+    config["enrich_workers"] = 4
+    config["max_body_length"] = 200
+    # カスタム絵文字のリアクションの通知のアイコン(emoji: 絵文字の画像, user: ユーザーのアイコン)と絵文字の一覧を取得し直す間隔(秒)
+    config["reaction_icon"] = "emoji"
+    config["emoji_refresh_interval"] = 3600
+    # 受け取る通知の種類(falseにした種類は通知しない)
+    config["notify_types"] = {
+        notify_type: True
+        for notify_type in (
+            "reaction",
+            "reply",
+            "mention",
+            "renote",
+            "quote",
+            "follow",
+            "followRequestAccepted",
+            "receiveFollowRequest",
+            "pollEnded",
+            "app",
+            "note",
+            "achievementEarned",
+            "roleAssigned",
+        )
+    }
+    # 同じノートへのリアクション/リノートをまとめる設定(falseにするとまとめない)
+    config["aggregate"] = {
+        "reaction": {"window": 3, "max_delay": 10},
+        "renote": {"window": 3, "max_delay": 10},
+    }
+    # トレイアイコンを使わずに起動するかどうか(--headlessと同じ)と通知の送信先
+    # 送信先の例: {"type": "desktop"}, {"type": "jsonl", "path": "-"}, {"type": "webhook", "url": "http://127.0.0.1:8080/"},
+    #             {"type": "unix", "path": "/run/misskey-notify.sock"} (それぞれtimeout(秒)とqueue_sizeも指定できる)
+    # desktop以外は"images": trueにした場合だけ通知の画像を取得する(画像を使う送信先が無ければ画像を取得しない)
+    # nullの場合はOSの通知(ヘッドレスの場合は標準出力にJSON Lines)
+    config["headless"] = False
+    config["sinks"] = None
+    # 終了時にキューに残っている通知を処理しきるまで待つ時間(秒)
+    config["shutdown_drain_timeout"] = 5
     config["log_level"] = "WARNING"
-    print("初期設定が完了しました\n誤入力した/再設定をしたい場合は`config.json`を削除してください")
-    json.dump(config, fp=open(file="config.json", mode="x", encoding="UTF-8"))
-    logging.basicConfig(
-        format="%(asctime)s %(name)s - %(levelname)s: %(message)s",  # 出力のフォーマット
-        datefmt="[%Y-%m-%dT%H:%M:%S%z]",  # 時間(asctime)のフォーマット
-        filename="./latest.log",
-        filemode="w",
-        encoding="UTF-8",
-        level=logging.WARNING,
+    # ログファイルの上限(MB)と残す古いログの数(前回以前の起動の分を含む)
+    config["log_max_mb"] = 10
+    config["log_backup_count"] = 5
+    # DEBUGの時に受信したペイロードをログに残す割合(0〜1)と最大の長さ
+    config["log_payload_sample_rate"] = 0.1
+    config["log_payload_max_bytes"] = 1024
+    # 計測結果の概要をlatest.logに出す間隔(秒, 0で無効)とPrometheus形式のエンドポイントのポート(nullで無効)
+    config["metrics_summary_interval"] = 300
+    config["metrics_port"] = None
+    print(
+        "初期設定が完了しました\n誤入力した/再設定をしたい場合は`config.json`を削除してください\n"
+        "複数のアカウントを使う場合は`config.json`の`accounts`に追加してください\n"
+        "アンテナ/リスト/ハッシュタグのノートも通知する場合はアカウントに`channels`を追加してください\n"
+        '(例: "channels": [{"channel": "antenna", "params": {"antennaId": "..."}, "name": "アンテナ"}])'
     )
-    log_main = logging.getLogger("main")
-    log_img = logging.getLogger("img_get")
-    log_notify = logging.getLogger("notifier")
-    log_main.info("Config file create&saved")
-ws_url = f'wss://{config["host"]}/streaming?i={config["i"]}'
-
-# 画像保存用の.dataフォルダが存在しない場合作成するように
-if not os.path.exists(".data"):
-    os.mkdir(".data")
-    log_main.info("Create './.data' directory")
-
-# /./data/hash.jsonが存在するかどうかの確認
-if not os.path.exists(".data/hash.json"):
-    open(file=".data/hash.json", mode="x", encoding="UTF-8").write("{}")
-    log_main.info("Create './.data/hash.json' file")
-
-
-# 生存確認
-log_main.info("Connection check")
-try:
-    resp_code = requests.request(
-        "GET", f'https://{config["host"]}', timeout=config["request_timeout"]
-    ).status_code
-    log_main.info("Connection check success")
-except requests.exceptions.ConnectionError:
-    print("サーバーへの接続ができませんでした\n入力したドメインが正しいかどうかを確認してください")
-    log_main.critical("Cannot connect to server! Please check domain.")
-    exit()
-match resp_code:
-    case 404:
-        print(
-            "API接続ができませんでした\n - 利用しているインスタンスが正常に稼働しているか\n - 入力したドメインが正しいかどうか\nを確認してください"
-        )
-        log_main.critical("Unable to connect to API! Please check domain and token.")
-        exit()
-    case 410 | 500 | 502 | 503:
-        print(
-            "サーバーが正常に応答しませんでした\n利用しているインスタンスが正常に稼働しているかを確認してください\nStatusCode:",
-            resp_code,
-        )
-        log_main.critical(
-            "Server is not responding normally! Please check instance is running. StatusCode:",
-            resp_code,
-        )
-        exit()
-    case 429:
-        print("レートリミットに達しました\nしばらくしてから再実行してください")
-        log_main.critical("Rate limit reached! Please try again later.")
-        exit()
-
-log_main.info("Misskey API connection check")
-try:
-    mk = Misskey(config["host"], i=config["i"])
-    log_main.info("Misskey API connection check success")
-except requests.exceptions.ConnectionError:
-    print("ドメインが違います\nconfig.jsonを削除/編集してもう一度入力しなおしてください")
-    log_main.critical("Domain is wrong! Please check domain.")
-    exit()
-except mk_exceptions.MisskeyAuthorizeFailedException:
-    print("APIキーが違います\nconfig.jsonを削除/編集して入力しなおしてください")
-    log_main.critical("API key is wrong! Please check API key.")
-    exit()
-try:
-    me = mk.i()
-except requests.exceptions.JSONDecodeError:
-    print("サーバー接続時にエラーが発生しました\nドメイン/APIキーが正しいかどうか確認してください")
-    log_main.critical("Cannot connect to server! Please check domain/API key.")
-    exit()
+    json.dump(config, fp=open(file="config.json", mode="x", encoding="UTF-8"))
+    config_message = "Config file create&saved"
+
+# ログの書き込みは別スレッドで行う(終了時にlog_listener.stop()で残りを書き込む)
+log_listener = setup_logging(
+    level=LOG_LEVELS.get(config.get("log_level"), logging.WARNING),
+    path="./latest.log",
+    max_bytes=int(config.get("log_max_mb", 10) * 1024 * 1024),
+    backup_count=config.get("log_backup_count", 5),
+)
+log_main = logging.getLogger("main")
+log_main.info(config_message)
+# 計測結果の概要はログのレベルに関わらずlatest.logに出す
+logging.getLogger("metrics").setLevel(logging.INFO)
+# 旧形式(host/iを直接書く形式)のconfig.jsonは1アカウントとして扱う
+if "accounts" not in config:
+    config["accounts"] = [{"host": config["host"], "i": config["i"]}]
+headless = args.headless or config.get("headless", False)
 
 
 class main:
     def __init__(self) -> None:
-        # self.loop = asyncio.get_event_loop()
-        self.websocket_task = None
         self.icon_task = None
-
-    @staticmethod
-    def get_image(url: str | dict, name: str | None = None) -> str:
-        """
-        通知に使用する画像が存在するかどうか確認するための関数
-        画像が存在した場合その画像のパスを返し
-        画像が存在しない場合その画像をダウンロードしてパスを返す
-
-        Args:
-            url (str | dict): 確認する画像のURL
-                                ユーザーのアイコンの場合はrecv_body['user'](dict)をそのまま突っ込む
-                                アプリのアイコンの場合は画像のURL(str)をそのまま突っ込む
-            name (str | None, optional): アプリの画像を確認する場合にアプリ名を突っ込む
-                                                ユーザーのアイコン確認の際は無視して可
-
-        Returns:
-            image_path str: 画像のパス
-        """
-
-        log_img.info("get_image called")
-
-        # 引数urlがdictかどうか(指定されているのがユーザーのアイコンなのか)を判断
-        if isinstance(url, dict):
-            log_img.debug("url is dict")
-            name = url["id"]  # 画像保存時の名前用にuidを格納
-            url = url["avatarUrl"]  # 引数から画像URLを取得し再格納
-        img_path = glob(f"./.data/{name}.*")
-        try:
-            img_data = requests.get(url, timeout=config["request_timeout"])  # type: ignore
-            hash_json = json.load(open(file=".data/hash.json", mode="r"))
-        except requests.exceptions.ConnectionError:
-            log_img.warning("request failed")
-            return "icon/icon.png"
-        if len(img_path) != 0:
-            img_path = img_path[0]
-            # ハッシュを格納しているjsonファイルをロード
-            if name in hash_json:
-                if hash_json[name] == sha256(img_data.content).hexdigest():
-                    log_img.info("Connection error: No image downloaded")
-                    return img_path
-
-        try:
-            if img_data.status_code == 200:  # ステータスが200かどうかを確認
-                with BytesIO(img_data.content) as buf:
-                    img = Image.open(buf)
-                    img_path = f".data/{name}.{img.format.lower()}"  # type: ignore | 返り値用の変数にパスを格納
-                    img.save(img_path)  # なんやかんや保存
-                    log_img.info("Image saved")
-
-                hash_json[name] = sha256(img_data.content).hexdigest()
-                json.dump(hash_json, open(file=".data/hash.json", mode="w"))
-                log_img.info("Hash saved")
-            else:
-                log_img.info("StatusCode error: No image downloaded")
-                img_path = "icon/icon.png"  # 返り値用の変数にアプリアイコンのパスを格納
-        except requests.exceptions.ConnectionError:
-            log_img.info("Connection error: No image downloaded")
-            img_path = "icon/icon.png"  # 返り値用の変数にアプリアイコンのパスを格納
-
-        log_img.info("return")
-        return img_path  # みんな大好きreturn
-
-    @staticmethod
-    async def notify_def(title: str, content: str, img: str) -> None:
-        """
-        通知を送信するための関数
-
-        Args:
-            title (str): 通知のタイトル
-            content (str): 通知の内容
-            img (str): 通知に表示する画像のパス
-
-        Returns:
-            None
-        """
-
-        log_notify.info("notify_def called")
-        notifier.title = title
-        notifier.message = content
-        notifier.icon = img
-        notifier.send()
-
-    @staticmethod
-    async def websocket_connect():
-        """
-        websocket接続するためのやつ
-        """
-        while True:
-            try:
-                async with websockets.connect(ws_url) as ws:  # websocket接続
-                    print("ws connect")
-                    log_main.info("Websocket connected")
-                    await ws.send(
-                        json.dumps(
-                            {"type": "connect", "body": {"channel": "main", "id": "1"}}
-                        )  # チャンネル接続をする旨を送信
-                    )
-                    log_main.info("Send channel connection payload")
-                    print("ready")
-                    log_main.info("ready")
-                    ws_reconnect_count = 0
-                    while True:
-                        recv = json.loads(await ws.recv())
-                        log_main.info("payload received")
-                        log_main.debug(recv)  # デバッグ用
-                        if recv["type"] == "channel":
-                            if recv["body"]["type"] == "notification":
-                                recv_body = recv["body"]["body"]
-                                if recv_body.get("user") is not None:
-                                    name = (
-                                        recv_body["user"]["name"]
-                                        if recv_body["user"]["name"] is not None
-                                        else recv_body["user"]["username"]
-                                    )
-                                match recv_body["type"]:  # 通知の種類によって動作を分ける
-                                    case "reaction":  # リアクション
-                                        log_main.debug("Type: reaction")
-                                        if (
-                                            re.match(r".+@", recv_body["reaction"])
-                                            is not None
-                                        ):
-                                            emoji = re.match(
-                                                r".+@", recv_body["reaction"]
-                                            )
-                                            title = f"{name}が{emoji.group()[1:-1]}でリアクションしました"
-                                        else:
-                                            emoji = recv_body["reaction"]
-                                            title = f"{name}が{emoji}でリアクションしました"
-                                        await main.notify_def(
-                                            title=title,
-                                            content=recv_body["note"]["text"],
-                                            img=main.get_image(recv_body["user"]),
-                                        )
-
-                                    case "reply":  # リプライ
-                                        log_main.debug("Type: reply")
-                                        msg = re.sub(
-                                            pattern=r"(@.+@.+\..+\s)",
-                                            repl="",
-                                            string=recv_body["note"]["text"],
-                                            count=len(
-                                                re.findall(
-                                                    pattern=r"(@.+@.+\..+\s)",
-                                                    string=recv_body["note"]["text"],
-                                                )
-                                            ),
-                                        )
-                                        await main.notify_def(
-                                            title=f"{name}が返信しました",
-                                            content=f'{msg}\n------------\n{recv_body["note"]["reply"]["text"]}',
-                                            img=main.get_image(recv_body["user"]),
-                                        )
-
-                                    case "mention":  # メンション
-                                        log_main.debug("Type: mention")
-                                        await main.notify_def(
-                                            title=f"{name}がメンションしました",
-                                            content=re.sub(
-                                                pattern=r"(@.+@.+\..+\s)",
-                                                repl="",
-                                                string=recv_body["note"]["text"],
-                                                count=len(
-                                                    re.findall(
-                                                        pattern=r"(@.+@.+\..+\s)",
-                                                        string=recv_body["note"][
-                                                            "text"
-                                                        ],
-                                                    )
-                                                ),
-                                            ),
-                                            img=main.get_image(recv_body["user"]),
-                                        )
-
-                                    case "renote":  # リノート
-                                        log_main.debug("Type: renote")
-                                        await main.notify_def(
-                                            title=f"{name}がリノートしました",
-                                            content=recv_body["note"]["renote"]["text"],
-                                            img=main.get_image(recv_body["user"]),
-                                        )
-
-                                    case "quote":  # 引用リノート
-                                        log_main.debug("Type: quote")
-                                        await main.notify_def(
-                                            title=f"{name}が引用リノートしました",
-                                            content=f'{recv_body["note"]["text"]}\n-------------\n{recv_body["note"]["renote"]["text"]}',
-                                            img=main.get_image(recv_body["user"]),
-                                        )
-
-                                    case "follow":  # フォロー
-                                        log_main.debug("Type: follow")
-                                        await main.notify_def(
-                                            title=f'{name}@{recv_body["user"]["host"]}',
-                                            content="ホョローされました",
-                                            img=main.get_image(recv_body["user"]),
-                                        )
-
-                                    case "followRequestAccepted":  # フォロー承認
-                                        log_main.debug("Type: followRequestAccepted")
-                                        await main.notify_def(
-                                            title=f'{name}@{recv_body["user"]["host"]}',
-                                            content="ホョローが承認されました",
-                                            img=main.get_image(recv_body["user"]),
-                                        )
-
-                                    case "receiveFollowRequest":  # フォローリクエスト
-                                        log_main.debug("Type: receiveFollowRequest")
-                                        await main.notify_def(
-                                            title=f'{name}@{recv_body["user"]["host"]}',
-                                            content="ホョローがリクエストされました",
-                                            img=main.get_image(recv_body["user"]),
-                                        )
-
-                                    case "pollEnded":  # 投票終了
-                                        log_main.debug("Type: pollEnded")
-                                        votes = 0
-                                        most_vote = None
-                                        voted = None
-                                        if recv_body["note"]["user"]["id"] == me["id"]:
-                                            title = "自身が開始したアンケートの結果が出ました"
-                                        else:
-                                            title = f'{recv_body["note"]["user"]["name"]}のアンケートの結果が出ました'
-                                        message = (
-                                            f'{recv_body["note"]["text"]}\n------------'
-                                        )
-                                        for choice in recv_body["note"]["poll"][
-                                            "choices"
-                                        ]:
-                                            if choice["isVoted"]:
-                                                voted = choice
-                                            else:
-                                                if choice["votes"] > votes:
-                                                    most_vote = choice
-                                                    votes = choice["votes"]
-                                        if most_vote is None:
-                                            message += f'\n✅🏆:{voted["text"]}|{voted["votes"]}票'
-                                        else:
-                                            if voted is not None:
-                                                message += f'\n✅  :{voted["text"]}|{voted["votes"]}票'
-                                            message += f'\n  🏆:{most_vote["text"]}|{most_vote["votes"]}票'
-                                        await main.notify_def(
-                                            title=title,
-                                            content=message,
-                                            img=main.get_image(recv_body["user"]),
-                                        )
-
-                                    case "app":  # アプリ通知
-                                        log_main.debug("Type: app")
-                                        await main.notify_def(
-                                            title=recv_body["header"],
-                                            content=recv_body["body"],
-                                            img=main.get_image(
-                                                recv_body["icon"], recv_body["header"]
-                                            ),
-                                        )
-                            else:
-                                pass
-            except websockets.exceptions.ConnectionClosedError:
-                if ws_reconnect_count == config["ws_reconnect_limit"]:
-                    print("websocket disconnected. reconnect limit reached.")
-                    log_main.critical(
-                        "websocket disconnected. reconnect limit reached."
-                    )
-                    await main.notify_def(
-                        title=app_name,
-                        content="再接続の回数が既定の回数を超えたため中断して終了します",
-                        img=app_icon,
-                    )
-                    return
-                log_main.warning(
-                    "Websocket disconnected. reconecting...\ntrials count: ",
-                    ws_reconnect_count,
-                )
-                await main.notify_def(
-                    title=app_name, content="サーバーから切断されました\n5秒後に再接続します...", img=app_icon
-                )
-
-                await asyncio.sleep(5)
-                ws_reconnect_count += 1
+        self.commands: CommandBridge | None = None  # トレイのメニューやシグナルからイベントループへの窓口
 
     def stopper(self):
-        """アプリ終了時に呼び出す関数"""
+        """アプリ終了時に呼び出す関数(トレイのスレッドからもイベントループからも呼び出せる)"""
         log_main.info("stopper called")
-        main.websocket_task.cancel()
-        icon.stop()
+        self.commands.shutdown()
 
-    async def runner(self, icon):
+    async def runner(self, icon=None):
         """
         ### アプリ起動時に呼び出されるやつ
         引数:
-            icon:
+            icon: トレイアイコン(ヘッドレスの場合はNone)
         """
 
-        self.websocket_task = asyncio.create_task(main.websocket_connect())
-        log_main.info("Start websocket task")
-        self.icon_task = asyncio.create_task(asyncio.to_thread(icon.run))
-        log_main.info("Start icon task")
+        loop = asyncio.get_running_loop()
+        self.commands = CommandBridge(client, loop, on_shutdown=icon.stop if icon is not None else None)
+        client.start()
+        if icon is not None:
+            self.icon_task = asyncio.create_task(asyncio.to_thread(icon.run))
+            log_main.info("Start icon task")
+        else:
+            # ヘッドレスの場合はSIGINT/SIGTERMで終了する(残っている通知は送りきってから終わる)
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                try:
+                    loop.add_signal_handler(signum, self.stopper)
+                except (NotImplementedError, RuntimeError):  # Windowsでは使えない(Ctrl+Cはタスクのキャンセルになる)
+                    pass
 
         try:
-            await self.websocket_task
-            await self.icon_task
+            await client.wait()
+            if self.icon_task is not None:
+                await self.icon_task
         except asyncio.CancelledError:
             log_main.info("task cancelled")
             print("task cancelled")
+        finally:
+            await client.close(config.get("shutdown_drain_timeout", 5))
 
 
 main = main()
 
+client = Client(
+    config,
+    sinks=config.get("sinks") or ([{"type": "jsonl", "path": "-"}] if headless else [{"type": "desktop"}]),
+    app_name=app_name,
+    app_icon=app_icon,
+    data_dir=".data",
+    started_at=startup_started,
+    on_all_stopped=main.stopper,
+)
+accounts = client.accounts
+
+
+# メニューの処理は全てCommandBridgeでイベントループに渡す(トレイのスレッドでは待たない)
+def read_action(account: Account):
+    """メニューから呼び出すための既読化の関数を作る(pystrayは引数の数で呼び方を変えるため)"""
+    return lambda: main.commands.mark_read(account)
+
 
-def notify_read():
+def reconnect_action(account: Account):
+    """メニューから呼び出すための再接続の関数を作る"""
+    return lambda: main.commands.reconnect(account)
+
+
+def build_icon():
     """
-    ### 通知を全部既読にする際に呼び出す関数
-    引数: 無し
+    トレイアイコンを作る関数
+    pystrayとPillowの読み込みはここで行う(ヘッドレスの場合は読み込まない)
     """
-    return_read = mk.notifications_mark_all_as_read()
-    if return_read:
-        message = "通知をすべて既読にしました"
-    else:
-        message = "通知の既読化に失敗しました"
-    asyncio.run(main.notify_def(title=app_name, content=message, img=app_icon))
-
-
-icon = pystray.Icon(
-    "Misskey-notify-client",
-    icon=Image.open(app_icon),
-    menu=pystray.Menu(
-        pystray.MenuItem("すべて既読にする", notify_read, checked=None),
-        pystray.MenuItem("終了", main.stopper, checked=None),
-    ),
-)
-# TODO: どの通知受け取るか設定できるように
+    import pystray
+    from PIL import Image
+
+    def toggle_pause():
+        """通知の一時停止/再開を切り替え、終わったらメニューのチェックを更新する"""
+        main.commands.toggle_pause().add_done_callback(lambda _: icon.update_menu())
+
+    def account_actions(account: Account) -> list[pystray.MenuItem]:
+        return [
+            pystray.MenuItem("すべて既読にする", read_action(account), checked=None),
+            pystray.MenuItem("今すぐ再接続", reconnect_action(account), checked=None),
+        ]
+
+    def account_menu_items() -> list[pystray.MenuItem]:
+        """アカウントごとのメニュー項目を作る関数(1アカウントの場合は今まで通りの平らなメニュー)"""
+        if len(accounts) == 1:
+            return account_actions(accounts[0])
+        return [
+            pystray.MenuItem(account.label, pystray.Menu(*account_actions(account)))
+            for account in accounts
+        ]
+
+    icon = pystray.Icon(
+        "Misskey-notify-client",
+        icon=Image.open(app_icon),
+        menu=pystray.Menu(
+            *account_menu_items(),
+            pystray.MenuItem("通知を一時停止", toggle_pause, checked=lambda item: client.paused),
+            pystray.MenuItem("終了", main.stopper, checked=None),
+        ),
+    )
+    return icon
 
 
-log_main.debug("test")
-log_main.info("test")
-log_main.warning("test")
-log_main.error("test")
-log_main.critical("test")
+icon = None if headless else build_icon()
 
 
-print("client_startup...")
-# icon_thread = threading.Thread(target=icon.run).start()
-print("icon starting...")
+if icon is not None:  # ヘッドレスの場合は標準出力を通知の出力に使うので何も出さない
+    print("client_startup...")
+    # icon_thread = threading.Thread(target=icon.run).start()
+    print("icon starting...")
 
-log_main.info("Start main task...")
-asyncio.run(main.runner(icon))
+log_main.info(f"Start main task... (headless={headless})")
+try:
+    # ヘッドレスの場合、接続状態などの表示は標準エラー出力に出す(標準出力は通知のJSON Linesに使う)
+    with contextlib.redirect_stdout(sys.stderr) if headless else contextlib.nullcontext():
+        asyncio.run(main.runner(icon))
+finally:
+    log_listener.stop()
@@ -0,0 +1,353 @@
+"""
+処理の各段の計測(カウンタ/ゲージ/ヒストグラム)と、Prometheusのテキスト形式で返すローカルのHTTPエンドポイント
+
+計測は全てイベントループのスレッドから行う前提なのでロックは取らない
+"""
+
+import asyncio
+import logging
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+log_metrics = logging.getLogger("metrics")
+
+# 秒単位のヒストグラムの既定のバケット(0.5ms〜10s)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value: str) -> str:
+    """ラベルの値をPrometheusのテキスト形式用にエスケープする(アカウント名などはユーザーが自由に付けるため)"""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _label_text(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """増えるだけの数値(ラベルごとに持つ)"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(str(labels.get(label, "")) for label in self.labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def total(self) -> float:
+        return sum(self.values.values())
+
+    def render(self) -> list[str]:
+        return [
+            f"{self.name}{_label_text(self.labels, key)} {value:g}"
+            for key, value in sorted(self.values.items())
+        ]
+
+
+class Gauge:
+    """増減する現在の値(ラベルごとに持つ)"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values: dict[tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels.get(label, "")) for label in self.labels)
+        self.values[key] = value
+
+    def get(self, **labels: str) -> float:
+        return self.values.get(tuple(str(labels.get(label, "")) for label in self.labels), 0)
+
+    def render(self) -> list[str]:
+        return [
+            f"{self.name}{_label_text(self.labels, key)} {value:g}"
+            for key, value in sorted(self.values.items())
+        ]
+
+
+class _Series:
+    __slots__ = ("buckets", "sum", "count")
+
+    def __init__(self, size: int) -> None:
+        self.buckets = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram:
+    """値の分布(ラベルごとにバケットごとの数/合計/件数を持つ)"""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.bounds = buckets
+        self.series: dict[tuple[str, ...], _Series] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels.get(label, "")) for label in self.labels)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = _Series(len(self.bounds))
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                series.buckets[i] += 1
+                break
+        series.sum += value
+        series.count += 1
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """withブロックの実行時間(秒)を記録する"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def quantile(self, q: float, **labels: str) -> float | None:
+        """
+        バケットからおおよその分位数を求める(該当するバケットの上限を返す)
+
+        Returns:
+            float | None: 記録が無い場合はNone
+        """
+        key = tuple(str(labels.get(label, "")) for label in self.labels)
+        series = self.series.get(key)
+        if series is None or series.count == 0:
+            return None
+        rank = q * series.count
+        seen = 0
+        for bound, count in zip(self.bounds, series.buckets):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def render(self) -> list[str]:
+        lines = []
+        for key, series in sorted(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.bounds, series.buckets):
+                cumulative += count
+                le = 'le="%g"' % bound
+                lines.append(f"{self.name}_bucket{_label_text(self.labels, key, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_label_text(self.labels, key, le)} {series.count}")
+            lines.append(f"{self.name}_sum{_label_text(self.labels, key)} {series.sum:g}")
+            lines.append(f"{self.name}_count{_label_text(self.labels, key)} {series.count}")
+        return lines
+
+
+class Registry:
+    """計測項目をまとめたもの"""
+
+    def __init__(self) -> None:
+        self.metrics: list[Counter | Gauge | Histogram] = []
+
+    def counter(self, name: str, description: str, labels: tuple[str, ...] = ()) -> Counter:
+        metric = Counter(name, description, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, description: str, labels: tuple[str, ...] = ()) -> Gauge:
+        metric = Gauge(name, description, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(
+        self,
+        name: str,
+        description: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        metric = Histogram(name, description, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Prometheusのテキスト形式にする"""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+NOTIFICATIONS = REGISTRY.counter(
+    "misskey_notifications_received_total", "Notifications received per type", ("type",)
+)
+# DELIVERED/NOTIFY/LATENCYはパイプラインが送信の関数に渡すまで(sinksを使う場合は各sinkのキューに入れるまで)
+# sinkが実際に送りきったものはSINK_DELIVERED/SINK_LATENCYで数える
+DELIVERED = REGISTRY.counter(
+    "misskey_notifications_delivered_total",
+    "Notifications handed to delivery per type (queued for the sinks when sinks are used)",
+    ("type",),
+)
+DROPPED = REGISTRY.counter("misskey_queue_dropped_total", "Items dropped by a full queue", ("queue",))
+RECONNECTS = REGISTRY.counter("misskey_ws_reconnects_total", "Websocket disconnections", ("account",))
+WS_STALE = REGISTRY.counter(
+    "misskey_ws_stale_total", "Websocket connections dropped after a missed heartbeat", ("account",)
+)
+WS_UPTIME = REGISTRY.gauge(
+    "misskey_ws_uptime_seconds", "How long the current websocket connection has been live", ("account",)
+)
+WS_RTT = REGISTRY.histogram("misskey_ws_rtt_seconds", "Heartbeat ping/pong round-trip time", ("account",))
+HANDSHAKES = REGISTRY.counter(
+    "misskey_http_handshakes_total", "New HTTP connections (TCP/TLS handshakes)", ("host",)
+)
+CONNECTIONS_REUSED = REGISTRY.counter(
+    "misskey_http_connections_reused_total", "HTTP requests served by a kept-alive connection"
+)
+DNS_LOOKUPS = REGISTRY.counter("misskey_dns_lookups_total", "DNS lookups not served by the cache")
+FRAME_DECODE = REGISTRY.histogram("misskey_frame_decode_seconds", "Time to decode one streaming frame")
+IMAGE_GET = REGISTRY.histogram(
+    "misskey_get_image_seconds", "Time to resolve a notification image", ("result",)
+)
+NOTIFY = REGISTRY.histogram(
+    "misskey_notify_seconds", "Time to hand one notification to delivery (enqueue time when sinks are used)"
+)
+LATENCY = REGISTRY.histogram(
+    "misskey_notification_latency_seconds",
+    "Time from receiving a frame to handing it to delivery (until queued for the sinks when sinks are used)",
+    ("type",),
+)
+SINK_SECONDS = REGISTRY.histogram("misskey_sink_seconds", "Time for a sink to send one notification", ("sink",))
+SINK_FAILURES = REGISTRY.counter("misskey_sink_failures_total", "Failed or timed-out sends per sink", ("sink",))
+SINK_DROPPED = REGISTRY.counter("misskey_sink_dropped_total", "Notifications dropped by a full sink queue", ("sink",))
+SINK_DELIVERED = REGISTRY.counter(
+    "misskey_sink_delivered_total", "Notifications a sink finished sending per type", ("sink", "type")
+)
+SINK_LATENCY = REGISTRY.histogram(
+    "misskey_sink_latency_seconds",
+    "Time from receiving a frame to a sink finishing sending it",
+    ("sink", "type"),
+)
+
+
+def _ms(value: float | None) -> str:
+    if value is None:
+        return "-"
+    if value == float("inf"):
+        return ">10s"
+    return f"{value * 1000:g}ms"
+
+
+def _max_quantile(histogram: Histogram, q: float) -> float | None:
+    """全てのラベルの中で一番大きい分位数(アカウントごとのRTTの一番悪いものなど)"""
+    values = [histogram.quantile(q, **dict(zip(histogram.labels, key))) for key in histogram.series]
+    return max((value for value in values if value is not None), default=None)
+
+
+def summary() -> str:
+    """latest.logに出す1行の概要"""
+    received = ",".join(f"{key[0]}={value:g}" for key, value in sorted(NOTIFICATIONS.values.items()))
+    delivered = DELIVERED.total()
+    handshakes = HANDSHAKES.total()
+    parts = [
+        f"received[{received}]",
+        f"delivered={delivered:g}",
+        f"dropped={DROPPED.total():g}",
+        f"reconnects={RECONNECTS.total():g}",
+        f"stale={WS_STALE.total():g}",
+        f"handshakes={handshakes:g}({handshakes / delivered if delivered else 0:.2f}/ntf)",
+        f"reused={CONNECTIONS_REUSED.total():g}",
+        f"rtt_p99={_ms(_max_quantile(WS_RTT, 0.99))}",
+        f"decode_p99={_ms(FRAME_DECODE.quantile(0.99))}",
+        f"image_hit_p99={_ms(IMAGE_GET.quantile(0.99, result='hit'))}",
+        f"image_miss_p99={_ms(IMAGE_GET.quantile(0.99, result='miss'))}",
+        f"handoff_p99={_ms(NOTIFY.quantile(0.99))}",
+        f"sink_p99={_ms(_max_quantile(SINK_SECONDS, 0.99))}",
+        f"delivered_latency_p99={_ms(_max_quantile(SINK_LATENCY, 0.99))}",
+        f"sink_failures={SINK_FAILURES.total():g}",
+    ]
+    return "metrics: " + " ".join(parts)
+
+
+async def summary_worker(interval: float) -> None:
+    """一定の間隔で概要をログに出す"""
+    while True:
+        await asyncio.sleep(interval)
+        log_metrics.info(summary())
+
+
+class MetricsServer:
+    """
+    計測結果をPrometheusのテキスト形式で返すHTTPサーバー(GET /metrics)
+
+    依存を増やさないようasyncioのソケットで最低限のHTTPだけを話す
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 9464, registry: Registry = REGISTRY) -> None:
+        """
+        Args:
+            host (str, optional): 待ち受けるアドレス(既定ではローカルからのみ)
+            port (int, optional): 待ち受けるポート
+            registry (Registry, optional): 返す計測項目
+        """
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self._server: asyncio.Server | None = None
+
+    async def start(self) -> None:
+        try:
+            self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        except OSError as e:
+            log_metrics.warning(f"metrics endpoint could not be started: {e}")
+            return
+        log_metrics.info(f"metrics endpoint: http://{self.host}:{self.port}/metrics")
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+                pass  # ヘッダーは使わない
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", self.registry.render().encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+        except (TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,266 @@
+"""
+ストリーミングのフレームやAPIの結果から、フォーマッタが使う項目だけを持つ通知のオブジェクトを作るモジュール
+
+ユーザーやノートの他の項目(ファイル、絵文字、リアクションの集計など)は受け取った時点で捨てるので
+キューやまとめ中の通知がペイロード全体を抱え続けることは無い
+JSONの解析にはorjsonまたはmsgspecがインストールされていればそれを使い、無ければ標準のjsonを使う
+"""
+
+import json
+from typing import Any, Callable
+
+try:
+    import orjson
+
+    loads: Callable[[str | bytes], Any] = orjson.loads
+    JSON_BACKEND = "orjson"
+except ImportError:
+    try:
+        import msgspec
+
+        loads = msgspec.json.decode
+        JSON_BACKEND = "msgspec"
+    except ImportError:
+        loads = json.loads
+        JSON_BACKEND = "json"
+
+
+class User:
+    """通知に関係するユーザー"""
+
+    __slots__ = ("id", "name", "username", "host", "avatar_url")
+
+    def __init__(
+        self,
+        id: str,
+        username: str = "",
+        name: str | None = None,
+        host: str | None = None,
+        avatar_url: str | None = None,
+    ) -> None:
+        self.id = id
+        self.username = username
+        self.name = name
+        self.host = host  # ローカルのユーザーの場合はNone
+        self.avatar_url = avatar_url
+
+    def __repr__(self) -> str:
+        return f"<User {self.username}@{self.host}>"
+
+    @classmethod
+    def from_dict(cls, data: dict | None) -> "User | None":
+        if not data:
+            return None
+        return cls(
+            data["id"],
+            data.get("username") or "",
+            data.get("name"),
+            data.get("host"),
+            data.get("avatarUrl"),
+        )
+
+
+class PollChoice:
+    """アンケートの選択肢"""
+
+    __slots__ = ("text", "votes", "is_voted")
+
+    def __init__(self, text: str, votes: int = 0, is_voted: bool = False) -> None:
+        self.text = text
+        self.votes = votes
+        self.is_voted = is_voted
+
+
+class Note:
+    """通知に関係するノート(返信先/リノート元は1段だけ持つ)"""
+
+    __slots__ = ("id", "text", "user", "reply", "renote", "poll")
+
+    def __init__(
+        self,
+        id: str,
+        text: str | None = None,
+        user: User | None = None,
+        reply: "Note | None" = None,
+        renote: "Note | None" = None,
+        poll: tuple[PollChoice, ...] | None = None,
+    ) -> None:
+        self.id = id
+        self.text = text
+        self.user = user
+        self.reply = reply
+        self.renote = renote
+        self.poll = poll
+
+    def __repr__(self) -> str:
+        return f"<Note {self.id}>"
+
+    @classmethod
+    def from_dict(cls, data: dict | None, depth: int = 1) -> "Note | None":
+        if not data:
+            return None
+        # 多くのノートは返信/リノート/アンケートを持たないので、無い項目は呼び出しごと省く
+        get = data.get
+        user = get("user")
+        reply = get("reply") if depth > 0 else None
+        renote = get("renote") if depth > 0 else None
+        poll = get("poll")
+        return cls(
+            data["id"],
+            get("text"),
+            User.from_dict(user) if user else None,
+            cls.from_dict(reply, depth - 1) if reply else None,
+            cls.from_dict(renote, depth - 1) if renote else None,
+            tuple(
+                PollChoice(choice.get("text", ""), choice.get("votes", 0), choice.get("isVoted", False))
+                for choice in poll.get("choices", ())
+            )
+            if poll
+            else None,
+        )
+
+
+class Role:
+    """付与されたロール"""
+
+    __slots__ = ("id", "name", "icon_url")
+
+    def __init__(self, id: str, name: str = "", icon_url: str | None = None) -> None:
+        self.id = id
+        self.name = name
+        self.icon_url = icon_url
+
+    @classmethod
+    def from_dict(cls, data: dict | None) -> "Role | None":
+        if not data:
+            return None
+        return cls(data["id"], data.get("name") or "", data.get("iconUrl"))
+
+
+class Notification:
+    """1件の通知"""
+
+    __slots__ = (
+        "id",
+        "type",
+        "user",
+        "note",
+        "reaction",
+        "reaction_url",
+        "header",
+        "body",
+        "icon",
+        "achievement",
+        "role",
+    )
+
+    def __init__(
+        self,
+        id: str | None,
+        type: str,
+        user: User | None = None,
+        note: Note | None = None,
+        reaction: str | None = None,
+        reaction_url: str | None = None,
+        header: str | None = None,
+        body: str | None = None,
+        icon: str | None = None,
+        achievement: str | None = None,
+        role: Role | None = None,
+    ) -> None:
+        self.id = id
+        self.type = type
+        self.user = user
+        self.note = note
+        self.reaction = reaction
+        self.reaction_url = reaction_url  # リモートのカスタム絵文字のリアクションの場合の画像のURL
+        self.header = header  # アプリからの通知の場合のタイトル(アンテナなどのノートの場合はチャンネルの名前)
+        self.body = body  # アプリからの通知の場合の本文
+        self.icon = icon  # アプリからの通知の場合のアイコンのURL
+        self.achievement = achievement
+        self.role = role
+
+    def __repr__(self) -> str:
+        return f"<Notification {self.type} {self.id}>"
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Notification":
+        """
+        通知のdict(ストリーミングのbody.bodyまたはi/notificationsの1件)から作る
+
+        Args:
+            data (dict): 通知のdict
+
+        Returns:
+            Notification: 通知
+        """
+        get = data.get
+        user = get("user")
+        note = get("note")
+        reaction = get("reaction")
+        role = get("role")
+        return cls(
+            get("id"),
+            get("type", "unknown"),
+            User.from_dict(user) if user else None,
+            Note.from_dict(note) if note else None,
+            reaction,
+            _remote_emoji_url(reaction, note) if reaction else None,
+            get("header"),
+            get("body"),
+            get("icon"),
+            get("achievement"),
+            Role.from_dict(role) if role else None,
+        )
+
+
+def _remote_emoji_url(reaction: str | None, note: dict | None) -> str | None:
+    """
+    リモートのカスタム絵文字(:name@host:)のリアクションの画像のURLを、ノートに含まれている絵文字の情報から探す
+    (ノートの絵文字の情報はこのURL以外は保持しない)
+    """
+    if not reaction or not note or "@" not in reaction or reaction.endswith("@.:"):
+        return None
+    key = reaction.strip(":")
+    return (note.get("reactionEmojis") or {}).get(key) or (note.get("emojis") or {}).get(key)
+
+
+def decode_frame(frame: str | bytes) -> Notification | None:
+    """
+    ストリーミングのフレームを解析する
+
+    Args:
+        frame (str | bytes): 受信したフレーム
+
+    Returns:
+        Notification | None: 通知のフレームでない場合はNone
+    """
+    # 通知以外のフレーム(既読の同期など)は解析せずに捨てる
+    if (b'"notification"' if isinstance(frame, bytes) else '"notification"') not in frame:
+        return None
+    data = loads(frame)
+    if data.get("type") != "channel":
+        return None
+    body = data.get("body") or {}
+    if body.get("type") != "notification" or not body.get("body"):
+        return None
+    return Notification.from_dict(body["body"])
+
+
+def decode_channel_note(frame: str | bytes, source: str | None = None) -> Notification | None:
+    """
+    アンテナ/リスト/ハッシュタグなどのチャンネルのフレームを解析して、ノートの通知(type=note)にする
+
+    Args:
+        frame (str | bytes): 受信したフレーム
+        source (str | None, optional): 通知に表示するチャンネルの名前
+
+    Returns:
+        Notification | None: ノートのフレームでない場合はNone
+    """
+    data = loads(frame)
+    body = data.get("body") or {}
+    if body.get("type") != "note" or not body.get("body"):
+        return None
+    note = Note.from_dict(body["body"])
+    return Notification(note.id, "note", note.user, note, header=source)  # type: ignore[union-attr]
@@ -0,0 +1,250 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Hashable
+
+import metrics
+
+log_pipeline = logging.getLogger("pipeline")
+
+OVERFLOW_POLICIES = ("block", "drop_oldest", "coalesce")
+
+
+class Event:
+    """パイプラインを流れる1件の通知"""
+
+    __slots__ = ("body", "account", "group", "received_at")
+
+    def __init__(
+        self, body: Any, received_at: float | None = None, account: Any = None
+    ) -> None:
+        self.body = body
+        self.account = account  # 通知を受け取ったAccount
+        self.group = None  # まとめられた通知の場合はaggregator.Group
+        self.received_at = time.perf_counter() if received_at is None else received_at
+
+
+class StageQueue(asyncio.Queue):
+    """
+    溢れた時の動作を選べる上限付きのキュー
+
+    overflow:
+        block: 空きが出るまで待つ
+        drop_oldest: 一番古い項目を捨てて追加する
+        coalesce: 同じキーの項目がキューにあれば新しい方で置き換える(無ければdrop_oldestと同じ)
+    """
+
+    def __init__(
+        self,
+        name: str,
+        maxsize: int,
+        overflow: str = "drop_oldest",
+        key: Callable[[Any], Hashable] | None = None,
+    ) -> None:
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"unknown overflow policy: {overflow}")
+        super().__init__(maxsize)
+        self.name = name
+        self.overflow = overflow
+        self.key = key
+        self.dropped = 0
+        self.coalesced = 0
+
+    async def offer(self, item: Any) -> None:
+        """ポリシーに従ってキューに追加する"""
+        if self.overflow == "block":
+            await self.put(item)
+            return
+        if not self.full():
+            self.put_nowait(item)
+            return
+        if self.overflow == "coalesce" and self.key is not None:
+            item_key = self.key(item)
+            if item_key is not None:
+                for i, queued in enumerate(self._queue):  # type: ignore[attr-defined]
+                    if self.key(queued) == item_key:
+                        self._queue[i] = item  # type: ignore[attr-defined]
+                        self.coalesced += 1
+                        return
+        self.get_nowait()
+        self.task_done()
+        self.dropped += 1
+        metrics.DROPPED.inc(queue=self.name)
+        log_pipeline.warning(f"queue '{self.name}' is full. dropped oldest item")
+        self.put_nowait(item)
+
+
+class Pipeline:
+    """
+    受信 -> 解析 -> 画像取得などの肉付け -> 通知 の各段をキューでつないだもの
+    受信側は`submit`で生のフレームを入れるだけなので、通知が遅くても受信は止まらない
+    """
+
+    def __init__(
+        self,
+        parse: Callable[[Any], Event | None],
+        enrich: Callable[[Event], Awaitable[dict | None]],
+        deliver: Callable[..., Awaitable[None]],
+        queue_size: int = 100,
+        overflow: str = "drop_oldest",
+        enrich_workers: int = 4,
+        event_key: Callable[[Event], Hashable] | None = None,
+        stats_interval: float = 60,
+        aggregator: Any = None,
+        accept: Callable[[Event], bool] | None = None,
+        on_delivered: Callable[[Event, float], None] | None = None,
+    ) -> None:
+        """
+        Args:
+            parse (Callable): 生のフレームをEventに変換する関数(通知以外はNoneを返す)
+            enrich (Callable): Eventから通知の引数のdictを作るコルーチン関数(通知しない場合はNone)
+            deliver (Callable): 通知を送信するコルーチン関数
+            queue_size (int, optional): 各段のキューの上限
+            overflow (str, optional): キューが溢れた時の動作(block/drop_oldest/coalesce)
+            enrich_workers (int, optional): 肉付けを並行して行うワーカーの数
+            event_key (Callable | None, optional): coalesce時にEventをまとめるためのキー
+            stats_interval (float, optional): キューの状態をログに出す間隔(秒, 0で無効)
+            aggregator (Aggregator | None, optional): 解析後の通知をまとめるためのAggregator
+            accept (Callable | None, optional): 通知するかどうかを判定する関数(Falseの通知は肉付け前に捨てる)
+            on_delivered (Callable | None, optional): 通知を送信した後に(Event, 受信からの秒数)で呼び出す関数
+                                                      (deliverがsinkのキューに入れるだけの場合は入れた後)
+        """
+        self.parse = parse
+        self.enrich = enrich
+        self.deliver = deliver
+        self.enrich_workers = enrich_workers
+        self.stats_interval = stats_interval
+        # 生のフレームはまだキーが分からないのでcoalesceの場合もdrop_oldestで扱う
+        self.raw_queue = StageQueue(
+            "raw", queue_size, "drop_oldest" if overflow == "coalesce" else overflow
+        )
+        self.event_queue = StageQueue("event", queue_size, overflow, key=event_key)
+        self.deliver_queue = StageQueue("deliver", queue_size, overflow)
+        self.aggregator = aggregator
+        self.accept = accept
+        self.on_delivered = on_delivered
+        if aggregator is not None:
+            aggregator.emit = self.event_queue.offer
+        self._tasks: list[asyncio.Task] = []
+
+    @property
+    def queues(self) -> tuple[StageQueue, ...]:
+        return (self.raw_queue, self.event_queue, self.deliver_queue)
+
+    def depths(self) -> dict[str, int]:
+        """
+        各段のキューに溜まっている数を返す(監視用)
+
+        Returns:
+            depths dict[str, int]: キューの名前: 溜まっている数
+        """
+        return {queue.name: queue.qsize() for queue in self.queues}
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        """各段のキューの深さ/破棄数/置き換え数を返す(監視用)"""
+        return {
+            queue.name: {
+                "depth": queue.qsize(),
+                "dropped": queue.dropped,
+                "coalesced": queue.coalesced,
+            }
+            for queue in self.queues
+        }
+
+    async def submit(self, frame: Any) -> None:
+        """受信したフレームをパイプラインに入れる(受信時刻は遅延の計測に使う)"""
+        await self.raw_queue.offer((frame, time.perf_counter()))
+
+    async def inject(self, event: Event) -> None:
+        """解析済みの通知(APIから取得し直したものなど)をパイプラインに入れる"""
+        if self.accept is not None and not self.accept(event):
+            return
+        if self.aggregator is not None and self.aggregator.add(event):
+            return
+        await self.event_queue.offer(event)
+
+    def start(self) -> None:
+        """各段のワーカーを起動する"""
+        self._tasks.append(asyncio.create_task(self._parse_worker()))
+        for _ in range(self.enrich_workers):
+            self._tasks.append(asyncio.create_task(self._enrich_worker()))
+        self._tasks.append(asyncio.create_task(self._deliver_worker()))
+        if self.stats_interval > 0:
+            self._tasks.append(asyncio.create_task(self._stats_worker()))
+        log_pipeline.info("Pipeline started")
+
+    async def stop(self, drain_timeout: float = 0) -> None:
+        """
+        ワーカーを停止する
+
+        Args:
+            drain_timeout (float, optional): 残っている通知を処理しきるまで待つ時間(秒)
+        """
+        if drain_timeout > 0:
+            try:
+                async with asyncio.timeout(drain_timeout):
+                    # 先に生のフレームを解析しきってから、まとめている途中の通知を送り出す
+                    # (逆の順番だと後から解析されたリアクションが新しいまとまりに入ったまま送られない)
+                    await self.raw_queue.join()
+                    if self.aggregator is not None:
+                        self.aggregator.flush_all()
+                        await self.aggregator.wait_emitted()
+                    await self.event_queue.join()
+                    await self.deliver_queue.join()
+            except TimeoutError:
+                log_pipeline.warning(f"Pipeline drain timed out: {self.depths()}")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        log_pipeline.info("Pipeline stopped")
+
+    async def _parse_worker(self) -> None:
+        while True:
+            frame, received_at = await self.raw_queue.get()
+            try:
+                event = self.parse(frame)
+                if event is not None:
+                    event.received_at = received_at
+                    await self.inject(event)
+            except Exception:
+                log_pipeline.exception("parse failed")
+            finally:
+                self.raw_queue.task_done()
+
+    async def _enrich_worker(self) -> None:
+        while True:
+            event = await self.event_queue.get()
+            try:
+                args = await self.enrich(event)
+                if args is not None:
+                    await self.deliver_queue.offer((event, args))
+            except Exception:
+                log_pipeline.exception("enrich failed")
+            finally:
+                self.event_queue.task_done()
+
+    async def _deliver_worker(self) -> None:
+        while True:
+            event, args = await self.deliver_queue.get()
+            try:
+                # deliverに渡すまでの時間と遅延(sinksの場合はキューに入れるまで, 送りきるまでは各sinkで計測する)
+                with metrics.NOTIFY.time():
+                    await self.deliver(**args)
+                latency = time.perf_counter() - event.received_at
+                notify_type = event.body.type
+                metrics.DELIVERED.inc(type=notify_type)
+                metrics.LATENCY.observe(latency, type=notify_type)
+                log_pipeline.debug(f"delivered in {latency * 1000:.1f}ms")
+                if self.on_delivered is not None:
+                    self.on_delivered(event, latency)
+            except Exception:
+                log_pipeline.exception("deliver failed")
+            finally:
+                self.deliver_queue.task_done()
+
+    async def _stats_worker(self) -> None:
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            pending = self.aggregator.pending() if self.aggregator is not None else 0
+            log_pipeline.info(f"queue stats: {self.stats()}, aggregating: {pending}")
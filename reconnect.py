@@ -0,0 +1,79 @@
+import logging
+import random
+import time
+from collections import OrderedDict
+
+log_main = logging.getLogger("main")
+
+
+class Backoff:
+    """
+    再接続までの待ち時間を指数的に伸ばす(ジッター付き)
+
+    接続がhealthy_after秒以上続いてから切れた場合は正常だったとみなして試行回数をリセットする
+    """
+
+    def __init__(self, base: float = 1, cap: float = 60, healthy_after: float = 30) -> None:
+        """
+        Args:
+            base (float, optional): 1回目の待ち時間の上限(秒)
+            cap (float, optional): 待ち時間の上限(秒)
+            healthy_after (float, optional): 正常な接続とみなすまでの時間(秒)
+        """
+        self.base = base
+        self.cap = cap
+        self.healthy_after = healthy_after
+        self.attempts = 0
+        self._connected_at: float | None = None
+
+    def connected(self) -> None:
+        """接続できた時に呼び出す"""
+        self._connected_at = time.monotonic()
+
+    def disconnected(self) -> None:
+        """切断された/接続に失敗した時に呼び出す"""
+        if (
+            self._connected_at is not None
+            and time.monotonic() - self._connected_at >= self.healthy_after
+        ):
+            self.attempts = 0
+        self._connected_at = None
+
+    def next_delay(self) -> float:
+        """
+        次の再接続までの待ち時間を返して試行回数を1増やす
+
+        Returns:
+            float: 待ち時間(秒)
+        """
+        delay = random.uniform(0, min(self.cap, self.base * 2**self.attempts))
+        self.attempts += 1
+        return delay
+
+
+class RecentIds:
+    """ストリームと取りこぼし取得の両方から来た通知を重複させないための上限付きのID集合"""
+
+    def __init__(self, maxsize: int = 1000) -> None:
+        self.maxsize = maxsize
+        self._ids: OrderedDict[str, None] = OrderedDict()
+
+    def add(self, notification_id: str) -> bool:
+        """
+        IDを追加する
+
+        Args:
+            notification_id (str): 通知のID
+
+        Returns:
+            bool: 初めて見たIDの場合はTrue, 既に見たIDの場合はFalse
+        """
+        if notification_id in self._ids:
+            return False
+        self._ids[notification_id] = None
+        if len(self._ids) > self.maxsize:
+            self._ids.popitem(last=False)
+        return True
+
+    def __len__(self) -> int:
+        return len(self._ids)
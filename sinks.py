@@ -0,0 +1,338 @@
+"""
+通知の送信先(sink)
+
+各sinkは専用のキューとワーカーを持ち、1件ごとにタイムアウトを設けるので
+遅い/壊れたsinkが他のsinkへの送信を遅らせることは無い
+デスクトップの通知のライブラリは使う時まで読み込まない(ヘッドレスでの起動を軽くするため)
+"""
+
+import asyncio
+import json
+import logging
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+import aiohttp
+
+import metrics
+from http_client import ApiError, HttpClient
+
+log_notify = logging.getLogger("notifier")
+
+
+class Sink:
+    """
+    送信先の基底クラス
+
+    サブクラスはsendを実装する(closeは必要な場合のみ)
+    """
+
+    type: str = ""
+
+    def __init__(self, name: str | None = None, images: bool = False) -> None:
+        """
+        Args:
+            name (str | None, optional): ログや計測で使う名前(省略時はtype)
+            images (bool, optional): 通知の画像(img)を使うかどうか
+                                     画像を使うsinkが1つも無い場合は画像を取得せずアプリのアイコンのパスを送る
+        """
+        self.name = name or self.type
+        self.uses_image = images
+
+    async def send(self, message: dict) -> None:
+        """
+        通知を送信する
+
+        Args:
+            message (dict): title, content, imgと、通知の場合はtype, account, id, count
+        """
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        pass
+
+
+class DesktopSink(Sink):
+    """OSの通知(notify-py)"""
+
+    type = "desktop"
+
+    def __init__(self, name: str | None = None) -> None:
+        super().__init__(name, images=True)
+        from notifypy import Notify  # ヘッドレスの場合は読み込まない
+
+        self.notifier = Notify()
+        # OSの通知は同期処理なのでイベントループを止めないよう専用のスレッドで送信する
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="notifier")
+
+    async def send(self, message: dict) -> None:
+        await asyncio.get_running_loop().run_in_executor(
+            self._executor, self._send, message["title"], message["content"], message["img"]
+        )
+
+    def _send(self, title: str, content: str, img: str) -> None:
+        """OSの通知を送信する(通知用のスレッドで実行される)"""
+        self.notifier.title = title
+        self.notifier.message = content
+        self.notifier.icon = img
+        self.notifier.send()
+
+    async def close(self) -> None:
+        self._executor.shutdown(wait=False)
+
+
+class JsonlSink(Sink):
+    """JSON Lines(1件1行のJSON)を標準出力またはファイルに書く"""
+
+    type = "jsonl"
+
+    def __init__(self, path: str = "-", name: str | None = None, images: bool = False) -> None:
+        """
+        Args:
+            path (str, optional): 書き込むファイルのパス(-の場合は標準出力)
+        """
+        super().__init__(name, images)
+        self.path = path
+        # 標準出力は作った時点のものを使う(後で状態の表示を標準エラー出力に向けても通知はそのまま出す)
+        self._stdout = sys.stdout
+        self._file = None
+
+    async def send(self, message: dict) -> None:
+        line = json.dumps(message, ensure_ascii=False) + "\n"
+        await asyncio.to_thread(self._write, line)
+
+    def _write(self, line: str) -> None:
+        if self.path == "-":
+            self._stdout.write(line)
+            self._stdout.flush()
+            return
+        if self._file is None:
+            self._file = open(self.path, mode="a", encoding="UTF-8")
+        self._file.write(line)
+        self._file.flush()
+
+    async def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class WebhookSink(Sink):
+    """ローカルのWebhookにJSONをPOSTする"""
+
+    type = "webhook"
+
+    def __init__(
+        self,
+        url: str,
+        http: HttpClient,
+        headers: dict | None = None,
+        name: str | None = None,
+        images: bool = False,
+    ) -> None:
+        """
+        Args:
+            url (str): 送信先のURL
+            http (HttpClient): 共有するHTTPクライアント
+            headers (dict | None, optional): 追加のヘッダー(認証など)
+        """
+        super().__init__(name, images)
+        self.url = url
+        self.http = http
+        self.headers = headers
+
+    async def send(self, message: dict) -> None:
+        async with self.http.session.post(self.url, json=message, headers=self.headers) as resp:
+            await resp.read()
+            if resp.status >= 400:
+                raise ApiError(self.url, resp.status)
+
+
+class UnixSocketSink(Sink):
+    """Unixソケットに1件1行のJSONを書く(切断された場合は次の送信時に接続し直す)"""
+
+    type = "unix"
+
+    def __init__(self, path: str, name: str | None = None, images: bool = False) -> None:
+        """
+        Args:
+            path (str): ソケットのパス
+        """
+        super().__init__(name, images)
+        if not hasattr(asyncio, "open_unix_connection"):
+            raise ValueError("unix socket sink is not supported on this platform")
+        self.path = path
+        self._writer: asyncio.StreamWriter | None = None
+
+    async def send(self, message: dict) -> None:
+        if self._writer is None or self._writer.is_closing():
+            _, self._writer = await asyncio.open_unix_connection(self.path)
+        try:
+            self._writer.write((json.dumps(message, ensure_ascii=False) + "\n").encode())
+            await self._writer.drain()
+        except OSError:
+            self._writer.close()
+            self._writer = None
+            raise
+
+    async def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+class _SinkWorker:
+    """1つのsinkのキューとワーカー"""
+
+    def __init__(self, sink: Sink, queue_size: int, timeout: float) -> None:
+        self.sink = sink
+        self.timeout = timeout
+        self.queue: asyncio.Queue = asyncio.Queue(queue_size)
+        self.task: asyncio.Task | None = None
+
+    def offer(self, message: dict, received_at: float | None = None) -> None:
+        """
+        キューに入れる(溢れた場合は一番古いものを捨てる)
+
+        Args:
+            message (dict): 送信する内容
+            received_at (float | None, optional): フレームを受信した時刻(time.perf_counter), 遅延の計測用
+        """
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.queue.task_done()
+            metrics.SINK_DROPPED.inc(sink=self.sink.name)
+            log_notify.warning(f"sink '{self.sink.name}' is full. dropped oldest notification")
+        self.queue.put_nowait((message, received_at))
+
+    async def run(self) -> None:
+        while True:
+            message, received_at = await self.queue.get()
+            started = time.perf_counter()
+            try:
+                async with asyncio.timeout(self.timeout):
+                    await self.sink.send(message)
+                finished = time.perf_counter()
+                notify_type = message.get("type", "")
+                metrics.SINK_SECONDS.observe(finished - started, sink=self.sink.name)
+                metrics.SINK_DELIVERED.inc(sink=self.sink.name, type=notify_type)
+                if received_at is not None:
+                    metrics.SINK_LATENCY.observe(finished - received_at, sink=self.sink.name, type=notify_type)
+            except TimeoutError:
+                metrics.SINK_FAILURES.inc(sink=self.sink.name)
+                log_notify.warning(f"sink '{self.sink.name}' timed out")
+            except (OSError, aiohttp.ClientError, ApiError) as e:
+                metrics.SINK_FAILURES.inc(sink=self.sink.name)
+                log_notify.warning(f"sink '{self.sink.name}' failed: {e!r}")
+            except Exception:
+                metrics.SINK_FAILURES.inc(sink=self.sink.name)
+                log_notify.exception(f"sink '{self.sink.name}' failed")
+            finally:
+                self.queue.task_done()
+
+
+class SinkDispatcher:
+    """通知を全てのsinkに並行して送る"""
+
+    def __init__(self) -> None:
+        self._workers: list[_SinkWorker] = []
+
+    @property
+    def sinks(self) -> list[Sink]:
+        return [worker.sink for worker in self._workers]
+
+    @property
+    def uses_image(self) -> bool:
+        """通知の画像を使うsinkがあるかどうか"""
+        return any(worker.sink.uses_image for worker in self._workers)
+
+    def add(self, sink: Sink, queue_size: int = 100, timeout: float = 10) -> None:
+        """
+        送信先を追加する
+
+        Args:
+            sink (Sink): 送信先
+            queue_size (int, optional): このsinkのキューの上限
+            timeout (float, optional): 1件の送信のタイムアウト(秒)
+        """
+        self._workers.append(_SinkWorker(sink, queue_size, timeout))
+
+    def start(self) -> None:
+        for worker in self._workers:
+            worker.task = asyncio.create_task(worker.run())
+
+    async def deliver(
+        self, title: str, content: str, img: str, received_at: float | None = None, **meta: Any
+    ) -> None:
+        """
+        通知を各sinkのキューに入れる(送信の完了は待たない)
+        受信から送信完了までの遅延と送信数は、各sinkが送りきった時にsinkごとに記録する
+
+        Args:
+            title (str): 通知のタイトル
+            content (str): 通知の内容
+            img (str): 通知に表示する画像のパス
+            received_at (float | None, optional): フレームを受信した時刻(time.perf_counter), sinkには送らない
+            **meta: 通知の種類などの付加情報(JSONで送るsinkに含める)
+        """
+        log_notify.info("notify_def called")
+        message = {"title": title, "content": content, "img": img, **meta}
+        for worker in self._workers:
+            worker.offer(message, received_at)
+
+    async def close(self, drain_timeout: float = 0) -> None:
+        """
+        ワーカーを止める
+
+        Args:
+            drain_timeout (float, optional): キューに残っている通知を送りきるまで待つ時間(秒)
+        """
+        if drain_timeout > 0:
+            try:
+                async with asyncio.timeout(drain_timeout):
+                    for worker in self._workers:
+                        await worker.queue.join()
+            except TimeoutError:
+                log_notify.warning("sink drain timed out")
+        for worker in self._workers:
+            if worker.task is not None:
+                worker.task.cancel()
+        await asyncio.gather(
+            *(worker.task for worker in self._workers if worker.task is not None),
+            return_exceptions=True,
+        )
+        for worker in self._workers:
+            await worker.sink.close()
+
+
+def build_sinks(configs: list[dict], http: HttpClient) -> SinkDispatcher:
+    """
+    config.jsonのsinksから送信先を作る
+
+    例: [{"type": "desktop"}, {"type": "jsonl", "path": "-"}, {"type": "webhook", "url": "http://127.0.0.1:8080/"},
+         {"type": "unix", "path": "/run/misskey-notify.sock", "timeout": 2, "queue_size": 50, "images": true}]
+
+    Raises:
+        ValueError: 不明な種類の場合
+    """
+    dispatcher = SinkDispatcher()
+    for sink_config in configs:
+        options = dict(sink_config)
+        sink_type = options.pop("type")
+        queue_size = options.pop("queue_size", 100)
+        timeout = options.pop("timeout", 10)
+        match sink_type:
+            case "desktop":
+                sink: Sink = DesktopSink(**options)
+            case "jsonl":
+                sink = JsonlSink(**options)
+            case "webhook":
+                sink = WebhookSink(http=http, **options)
+            case "unix":
+                sink = UnixSocketSink(**options)
+            case _:
+                raise ValueError(f"unknown sink type: {sink_type}")
+        dispatcher.add(sink, queue_size, timeout)
+    return dispatcher
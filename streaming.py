@@ -0,0 +1,256 @@
+"""
+ストリーミングAPIの1本のwebsocketに複数のチャンネルを載せて、受信したフレームをチャンネルIDで振り分けるモジュール
+
+半開きのTCP接続(相手が落ちたのに切断が届かない)は何分も気付けないので
+アプリケーションレベルのping/pongで一定時間応答が無ければ切断して再接続させる
+"""
+
+import asyncio
+import json
+import logging
+import re
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable
+
+import websockets
+
+import metrics
+from notification import loads
+
+log_main = logging.getLogger("main")
+
+# Misskeyのチャンネルのフレームは{"type":"channel","body":{"id":"...", ...}}の順で送られてくるので
+# 先頭だけを見てチャンネルIDを取り出す(フレーム全体の解析は後のワーカーで行う)
+_CHANNEL_ID = re.compile(r'\{\s*"type"\s*:\s*"channel"\s*,\s*"body"\s*:\s*\{\s*"id"\s*:\s*"([^"\\]*)"')
+_CHANNEL_ID_BYTES = re.compile(_CHANNEL_ID.pattern.encode())
+
+
+def channel_id(frame: str | bytes) -> str | None:
+    """
+    チャンネルのフレームのチャンネルIDを返す
+
+    Args:
+        frame (str | bytes): 受信したフレーム
+
+    Returns:
+        str | None: チャンネルのフレームでない場合はNone
+    """
+    if isinstance(frame, bytes):
+        match = _CHANNEL_ID_BYTES.match(frame)
+        if match is not None:
+            return match.group(1).decode()
+        if b'"channel"' not in frame:
+            return None
+    else:
+        match = _CHANNEL_ID.match(frame)
+        if match is not None:
+            return match.group(1)
+        if '"channel"' not in frame:
+            return None
+    # 項目の順番が違うサーバーの場合だけ全体を解析する
+    try:
+        data = loads(frame)
+    except ValueError:
+        return None
+    if not isinstance(data, dict) or data.get("type") != "channel":
+        return None
+    return (data.get("body") or {}).get("id")
+
+
+class StaleConnection(TimeoutError):
+    """ハートビートに応答が無かったため切断した"""
+
+
+class Channel:
+    """購読しているチャンネル"""
+
+    __slots__ = ("id", "name", "params", "label", "handler")
+
+    def __init__(
+        self,
+        id: str,
+        name: str,
+        handler: Callable[["Channel", str | bytes], Awaitable[None]],
+        params: dict | None = None,
+        label: str | None = None,
+    ) -> None:
+        self.id = id
+        self.name = name  # main, antenna, userList, hashtagなど
+        self.handler = handler
+        self.params = params or {}
+        self.label = label or name  # 通知に表示する名前
+
+    def __repr__(self) -> str:
+        return f"<Channel {self.name} {self.id}>"
+
+
+class StreamConnection:
+    """
+    1つのアカウントのストリーミング接続
+
+    購読するチャンネルは接続するたびに全て購読し直す
+    ハートビートは"ping"を送って"pong"を待つ(Misskeyのストリーミングの仕様)
+    "pong"を返さないサーバーの場合はwebsocketのpingフレームに切り替える
+    """
+
+    def __init__(self, url: str, label: str, ping_interval: float = 15, ping_timeout: float = 5) -> None:
+        """
+        Args:
+            url (str): ストリーミングAPIのURL(トークンを含む)
+            label (str): ログと計測に使うアカウントの名前
+            ping_interval (float, optional): ハートビートの間隔(秒, 0で無効)
+            ping_timeout (float, optional): 応答が無ければ切断するまでの時間(秒)
+        """
+        self.url = url
+        self.label = label
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.channels: dict[str, Channel] = {}
+        self.ws = None  # 接続中のwebsocket
+        self.connected_at: float | None = None  # 接続した時刻(time.monotonic)
+        self.rtt: float | None = None  # 最後に計ったping/pongの往復時間(秒)
+        self.app_ping = True  # Falseの場合はwebsocketのpingフレームを使う
+        self._pong_seen = False
+        self._pong = asyncio.Event()
+        self._stale = False
+
+    @property
+    def uptime(self) -> float:
+        """今の接続が続いている時間(秒, 切断中は0)"""
+        if self.connected_at is None:
+            return 0.0
+        return time.monotonic() - self.connected_at
+
+    def subscribe(
+        self,
+        name: str,
+        handler: Callable[[Channel, str | bytes], Awaitable[None]],
+        params: dict | None = None,
+        label: str | None = None,
+    ) -> Channel:
+        """
+        購読するチャンネルを追加する(接続中の場合は次の接続から)
+
+        Args:
+            name (str): チャンネルの名前(main, antenna, userList, hashtagなど)
+            handler (Callable): そのチャンネルのフレームを受け取るコルーチン関数(Channel, フレーム)
+            params (dict | None, optional): チャンネルのパラメータ(antennaId, listId, qなど)
+            label (str | None, optional): 通知に表示する名前(省略時はチャンネルの名前)
+
+        Returns:
+            Channel: 追加したチャンネル
+        """
+        channel = Channel(str(len(self.channels) + 1), name, handler, params, label)
+        self.channels[channel.id] = channel
+        return channel
+
+    @asynccontextmanager
+    async def connect(self) -> AsyncIterator["StreamConnection"]:
+        """
+        接続して全てのチャンネルを購読する(抜ける時に切断する)
+
+        Raises:
+            websockets.exceptions.InvalidHandshake, OSError, TimeoutError: 接続できなかった場合
+        """
+        options = {}
+        if self.ping_interval > 0:
+            # 生存確認は自前のハートビートで行うのでライブラリのpingは止める
+            options = {"ping_interval": None, "close_timeout": self.ping_timeout}
+        async with websockets.connect(self.url, **options) as ws:
+            self.ws = ws
+            self._stale = False
+            try:
+                for channel in self.channels.values():
+                    await ws.send(
+                        json.dumps(
+                            {
+                                "type": "connect",
+                                "body": {"channel": channel.name, "id": channel.id, "params": channel.params},
+                            }
+                        )
+                    )
+                self.connected_at = time.monotonic()
+                yield self
+            finally:
+                if self.connected_at is not None:
+                    log_main.info(f"[{self.label}] connection was live for {self.uptime:.0f}s")
+                self.ws = None
+                self.connected_at = None
+                metrics.WS_UPTIME.set(0, account=self.label)
+
+    async def serve(self) -> None:
+        """
+        切断されるまでフレームを受信してチャンネルごとのhandlerに渡す
+
+        Raises:
+            websockets.exceptions.ConnectionClosed: 切断された場合
+            StaleConnection: ハートビートに応答が無く切断した場合
+        """
+        ws = self.ws
+        heartbeat = asyncio.create_task(self._heartbeat(ws)) if self.ping_interval > 0 else None
+        try:
+            while True:
+                frame = await ws.recv()
+                if frame == "pong":
+                    self._pong_seen = True
+                    self._pong.set()
+                    continue
+                channel = self.channels.get(channel_id(frame))  # type: ignore[arg-type]
+                if channel is not None:
+                    await channel.handler(channel, frame)
+        except websockets.exceptions.ConnectionClosed as e:
+            if self._stale:
+                raise StaleConnection(f"no pong within {self.ping_timeout}s") from e
+            raise
+        finally:
+            if heartbeat is not None:
+                heartbeat.cancel()
+
+    async def close(self) -> None:
+        """接続中の場合は切断する"""
+        if self.ws is not None:
+            await self.ws.close()
+
+    async def _ping(self, ws, app: bool) -> bool:
+        """
+        pingを送って応答を待つ
+
+        Returns:
+            bool: ping_timeout秒以内に応答があった場合はTrue
+        """
+        try:
+            async with asyncio.timeout(self.ping_timeout):
+                if app:
+                    self._pong.clear()
+                    await ws.send("ping")
+                    await self._pong.wait()
+                else:
+                    await (await ws.ping())
+        except TimeoutError:
+            return False
+        return True
+
+    async def _heartbeat(self, ws) -> None:
+        """一定の間隔でpingを送り、応答が無ければ接続を捨てる(serveの受信がすぐに終わる)"""
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            sent = time.perf_counter()
+            alive = await self._ping(ws, self.app_ping)
+            if not alive and self.app_ping and not self._pong_seen:
+                # "pong"を返さないサーバーかもしれないのでwebsocketのpingで確かめる
+                sent = time.perf_counter()
+                alive = await self._ping(ws, False)
+                if alive:
+                    log_main.info(f"[{self.label}] server does not answer ping. using websocket ping frames")
+                    self.app_ping = False
+            if not alive:
+                log_main.warning(f"[{self.label}] no pong within {self.ping_timeout}s. dropping stale connection")
+                metrics.WS_STALE.inc(account=self.label)
+                self._stale = True
+                # 相手に届かない接続で閉じる手順を待っても仕方が無いので、すぐに切る
+                ws.transport.abort()
+                return
+            self.rtt = time.perf_counter() - sent
+            metrics.WS_RTT.observe(self.rtt, account=self.label)
+            metrics.WS_UPTIME.set(self.uptime, account=self.label)
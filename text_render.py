@@ -0,0 +1,204 @@
+"""
+通知の本文用にノートのテキストをプレーンテキストに変換するモジュール
+
+正規表現を使わず、文字列を先頭から1回なめるだけで処理するので
+長いノートや意図的に作られた入力でも処理時間は文字数に比例する
+"""
+
+from string import ascii_letters, digits
+
+_USERNAME_CHARS = frozenset(ascii_letters + digits + "_")
+_HOST_CHARS = frozenset(ascii_letters + digits + "_-.")
+_EMOJI_CHARS = frozenset(ascii_letters + digits + "_+-")
+_FN_NAME_CHARS = frozenset(ascii_letters + digits + "_.,=-")
+_SPACES = frozenset(" \t\r\n　")
+
+# 中身はそのまま残して取り除くだけのタグ
+_TAGS = ("<small>", "</small>", "<center>", "</center>", "<i>", "</i>", "<b>", "</b>", "<s>", "</s>")
+
+ELLIPSIS = "…"
+
+
+class _Finder:
+    """
+    str.findの結果を覚えておき、同じ文字列を何度も探す場合に同じ範囲を走査し直さないようにする
+    (閉じ括弧の無い入力が続いても全体で線形時間に収まる)
+    """
+
+    def __init__(self, text: str) -> None:
+        self.text = text
+        self._cache: dict[str, int] = {}
+
+    def find(self, sub: str, start: int) -> int:
+        pos = self._cache.get(sub)
+        if pos is None or (pos != -1 and pos < start):
+            pos = self.text.find(sub, start)
+            self._cache[sub] = pos
+        return pos
+
+
+def strip_leading_mentions(text: str) -> str:
+    """
+    先頭に並んでいるメンション(@user または @user@host)を取り除く
+
+    Args:
+        text (str): ノートのテキスト
+
+    Returns:
+        str: 先頭のメンションを取り除いたテキスト
+    """
+    n = len(text)
+    start = 0
+    while True:
+        i = start
+        while i < n and text[i] in _SPACES:
+            i += 1
+        if i >= n or text[i] != "@":
+            break
+        j = i + 1
+        while j < n and text[j] in _USERNAME_CHARS:
+            j += 1
+        if j == i + 1:
+            break
+        if j < n and text[j] == "@":
+            k = j + 1
+            while k < n and text[k] in _HOST_CHARS:
+                k += 1
+            if k == j + 1:
+                break
+            j = k
+        if j < n and text[j] not in _SPACES:
+            break
+        start = j
+    return text[start:].lstrip()
+
+
+def truncate(text: str, max_length: int | None) -> str:
+    """
+    通知に表示できる長さに切り詰める
+
+    Args:
+        text (str): テキスト
+        max_length (int | None): 最大の文字数(Noneの場合は切り詰めない)
+
+    Returns:
+        str: 切り詰めたテキスト
+    """
+    if max_length is None or len(text) <= max_length:
+        return text
+    return text[: max(max_length - 1, 0)] + ELLIPSIS
+
+
+def render(
+    text: str | None, max_length: int | None = None, strip_mentions: bool = False
+) -> str:
+    """
+    MFMをプレーンテキストに変換する
+
+    - $[tada ...] などの関数、**太字**、~~打ち消し~~、<small>などのタグは中身だけ残す
+    - [ラベル](URL) はラベルだけ残す
+    - :emoji@host: のようなカスタム絵文字は :emoji: にする
+    - `コード` と <plain> の中身はそのまま残す
+    - 行頭の引用記号(> )は取り除く
+
+    Args:
+        text (str | None): ノートのテキスト(Noneの場合は空文字を返す)
+        max_length (int | None, optional): 最大の文字数
+        strip_mentions (bool, optional): 先頭のメンションを取り除くかどうか
+
+    Returns:
+        str: プレーンテキスト
+    """
+    if not text:
+        return ""
+    if strip_mentions:
+        text = strip_leading_mentions(text)
+
+    out: list[str] = []
+    # 開いている "$[" と "[" のスタック(リンクの場合は出力した"["の位置を持つ)
+    stack: list[int | None] = []
+    n = len(text)
+    i = 0
+    line_start = True
+    finder = _Finder(text)
+    # 切り詰める長さを超えたらそれ以降は変換しない
+    limit = n if max_length is None else max_length
+    while i < n and len(out) <= limit:
+        c = text[i]
+
+        if line_start and c == ">":
+            # 引用
+            i += 2 if i + 1 < n and text[i + 1] == " " else 1
+            line_start = False
+            continue
+        line_start = c == "\n"
+
+        if c == "$" and i + 1 < n and text[i + 1] == "[":
+            j = i + 2
+            while j < n and text[j] in _FN_NAME_CHARS:
+                j += 1
+            if j > i + 2 and j < n and text[j] == " ":
+                stack.append(None)
+                i = j + 1
+                continue
+        elif c == "[" or (c == "?" and i + 1 < n and text[i + 1] == "["):
+            stack.append(len(out))
+            out.append("[")
+            i += 1 if c == "[" else 2
+            continue
+        elif c == "]" and stack:
+            opened = stack.pop()
+            if opened is None:
+                i += 1
+                continue
+            if i + 1 < n and text[i + 1] == "(":
+                close = finder.find(")", i + 2)
+                newline = finder.find("\n", i + 2)
+                if close != -1 and (newline == -1 or close < newline):
+                    out[opened] = ""
+                    i = close + 1
+                    continue
+        elif c in "*~" and i + 1 < n and text[i + 1] == c:
+            i += 2
+            continue
+        elif c == "<":
+            if text.startswith("<plain>", i):
+                close = finder.find("</plain>", i + 7)
+                if close != -1:
+                    out.extend(text[i + 7 : close])
+                    i = close + 8
+                    continue
+            for tag in _TAGS:
+                if text.startswith(tag, i):
+                    i += len(tag)
+                    break
+            else:
+                out.append(c)
+                i += 1
+            continue
+        elif c == "`":
+            fence = 3 if text.startswith("```", i) else 1
+            close = finder.find("`" * fence, i + fence)
+            if close != -1:
+                out.extend(text[i + fence : close].strip("\n") if fence == 3 else text[i + 1 : close])
+                i = close + fence
+                continue
+        elif c == ":":
+            j = i + 1
+            while j < n and text[j] in _EMOJI_CHARS:
+                j += 1
+            if j > i + 1 and j < n:
+                name_end = j
+                if text[j] == "@":
+                    j += 1
+                    while j < n and text[j] in _HOST_CHARS:
+                        j += 1
+                if j < n and text[j] == ":":
+                    out.extend(text[i : name_end + 1] if name_end == j else f"{text[i:name_end]}:")
+                    i = j + 1
+                    continue
+
+        out.append(c)
+        i += 1
+
+    return truncate("".join(out), max_length)